@@ -0,0 +1,158 @@
+import os
+import json
+import tempfile
+import numpy as np
+from astropy import units as u
+import multiprocessing as mp
+
+from vplanet_runner import VplanetRunner
+
+__all__ = ["BaraffeTable"]
+
+
+def _run_structure_track(args):
+
+    runner, mstar, max_age = args
+    return runner.run_model(np.array([mstar, 1.0, max_age]), units=False)
+
+
+class BaraffeTable:
+
+    # Baraffe stellar structure used by vplanet's stellar module, which depends only on
+    # mass and age: luminosity [Lsun], radius [Rsun], effective temperature [K] and
+    # radius of gyration, tabulated on a (mass, age) grid.
+    #
+    # directory/
+    #     table.json           output names and units
+    #     masses.npy           grid masses [Msun]
+    #     log_ages.npy         log10 grid stellar ages [yr]
+    #     log_<name>.npy       log10 values, shape (nmass, nage)
+    #
+    # Every array is memory-mapped read-only, so all processes using the table share
+    # the same pages; pickling (e.g. to pool workers) sends only the directory path.
+
+    NAMES = ["Luminosity", "Radius", "Temperature", "RadGyra"]
+    UNITS = {"Luminosity": u.Lsun, "Radius": u.Rsun, "Temperature": u.K, "RadGyra": u.dimensionless_unscaled}
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self._load()
+
+    def _load(self):
+
+        with open(os.path.join(self.directory, "table.json"), "r") as f:
+            self.names = json.load(f)["names"]
+
+        def load(name):
+            return np.load(os.path.join(self.directory, name + ".npy"), mmap_mode="r")
+
+        self.masses = load("masses")
+        self.log_ages = load("log_ages")
+        self.log_values = {name: load("log_" + name) for name in self.names}
+
+    def __getstate__(self):
+        return {"directory": self.directory}
+
+    def __setstate__(self, state):
+        self.directory = state["directory"]
+        self._load()
+
+    @classmethod
+    def build(cls, directory, masses, ages, inpath, ncores=mp.cpu_count(), time_init=5e6*u.yr):
+
+        # Tabulate the structure by running vplanet once per mass out to max(ages)
+        # (stellar ages in yr) and sampling each run on the age grid
+        runner = VplanetRunner(inparams={"star.dMass": u.Msun, "star.dRotPeriod": u.day, "vpl.dStopTime": u.yr},
+                               outparams={"final.star." + name: unit for name, unit in cls.UNITS.items()},
+                               inpath=inpath, time_init=time_init, timesteps=1e6*u.yr,
+                               prune_outputs=True)
+
+        masses = np.asarray(masses, dtype=float)
+        ages = np.asarray(ages, dtype=float)
+        run_time = ages.max() - time_init.to(u.yr).value
+
+        pool = mp.Pool(ncores)
+        tracks = pool.map(_run_structure_track, [(runner, mstar, run_time) for mstar in masses])
+        pool.close()
+
+        # vplanet's Time column counts from the start of the run at age time_init
+        t0 = time_init.to(u.yr).value
+        values = {}
+        for name in cls.NAMES:
+            values[name] = np.array([np.interp(ages, track["Time"] + t0, track["final.star." + name])
+                                     for track in tracks])
+
+        cls.save(directory, masses, ages, values)
+        return cls(directory)
+
+    @classmethod
+    def save(cls, directory, masses, ages, values):
+
+        # values: dict of output name -> array of shape (nmass, nage)
+        os.makedirs(directory, exist_ok=True)
+
+        arrays = {"masses": np.asarray(masses, dtype=float), "log_ages": np.log10(ages)}
+        for name, val in values.items():
+            arrays["log_" + name] = np.log10(val)
+
+        for name, val in arrays.items():
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, val)
+            os.replace(tmp, os.path.join(directory, name + ".npy"))
+
+        with open(os.path.join(directory, "table.json"), "w") as f:
+            json.dump({"names": list(values.keys()),
+                       "units": {name: cls.UNITS[name].to_string() for name in values.keys()}}, f)
+
+    def mass_weights(self, mass):
+
+        # lower grid index and linear weight in mass, clipped to the grid
+        mass = np.asarray(mass, dtype=float)
+        im = np.clip(np.searchsorted(self.masses, mass) - 1, 0, len(self.masses) - 2)
+        wm = (mass - self.masses[im]) / (self.masses[im+1] - self.masses[im])
+        return im, np.clip(wm, 0, 1)
+
+    def age_weights(self, age):
+
+        # lower grid index and linear weight in log age, clipped to the grid
+        la = np.clip(np.log10(age), self.log_ages[0], self.log_ages[-1])
+        ia = np.clip(np.searchsorted(self.log_ages, la) - 1, 0, len(self.log_ages) - 2)
+        wa = (la - self.log_ages[ia]) / (self.log_ages[ia+1] - self.log_ages[ia])
+        return ia, wa
+
+    def blend(self, name, im, wm, ia, wa):
+
+        # bilinear interpolation of log10 values between precomputed grid weights
+        tab = self.log_values[name]
+        lo = tab[im, ia] * (1 - wa) + tab[im, ia+1] * wa
+        hi = tab[im+1, ia] * (1 - wa) + tab[im+1, ia+1] * wa
+        return 10**(lo * (1 - wm) + hi * wm)
+
+    def lookup(self, mass, age, names=None):
+
+        # {name: values} for any broadcastable arrays of mass [Msun] and stellar age [yr]
+        mass, age = np.broadcast_arrays(np.asarray(mass, dtype=float), np.asarray(age, dtype=float))
+        im, wm = self.mass_weights(mass)
+        ia, wa = self.age_weights(age)
+
+        return {name: self.blend(name, im, wm, ia, wa) for name in (names or self.names)}
+
+    def lbol_radius(self, mass, age):
+
+        # bolometric luminosity [Lsun] and radius [Rsun] at mass [Msun] and stellar age [yr]
+        values = self.lookup(mass, age, names=["Luminosity", "Radius"])
+        return values["Luminosity"], values["Radius"]
+
+
+if __name__ == '__main__':
+
+    inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "infiles", "stellar")
+
+    # Baraffe grid mass range [Msun], stellar ages [yr]
+    masses = np.linspace(0.07, 1.4, 134)
+    ages = np.geomspace(5e6, 1.2e10, 500)
+
+    table = BaraffeTable.build("baraffe_table", masses, ages, inpath)
+    print("wrote baraffe_table/ with", table.names)
@@ -0,0 +1,226 @@
+import os
+import sys
+import csv
+import time
+import argparse
+import subprocess
+import numpy as np
+from astropy import units as u
+
+# Run run_alabi.py over many stars, data configurations and samplers with one command:
+#
+#     python batch_runner.py --stars "GJ 3470" Trappist-1 --configs model1 model3 \
+#                            --samplers emcee dynesty --ncores 64 --job-cores 16
+#
+# Each star is split into jobs: the shared initial design (run_alabi.run_initial_design),
+# then one surrogate training per configuration, then one job per sampler on each trained
+# surrogate. Every job runs as its own process with --job-cores cores; as many jobs run
+# at once as the --ncores budget allows, and the rest wait in a queue until their
+# dependencies finish and cores free up. All jobs share the on-disk track store and the
+# project-wide track library (run_alabi.store_dir / library_dir), so a track run by one
+# job is reused by every other.
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "docs", "data", "literature_constraints.csv")
+SCRIPT = os.path.abspath(__file__)
+
+# data each configuration of run_alabi.py needs
+CONFIG_DATA = {"model1": ["Lbol", "Lxray"],
+               "model2": ["Lbol", "Prot"],
+               "model3": ["Lbol", "Lxray", "Prot"]}
+
+# unit strings of the table that astropy does not parse as written
+UNIT_NAMES = {"days": "day"}
+
+PARAMETERS = {"stellar_mass": "mass",
+              "bolometric_luminosity": "Lbol",
+              "xray_luminosity": "Lxray",
+              "rotation_period": "Prot"}
+
+
+def load_constraints(file=DATA_FILE):
+
+    # {star: {"mass"/"Lbol"/"Lxray"/"Prot": [mean, std] * unit}} from the literature table.
+    # The first measurement listed for a parameter is used; parameters without a value
+    # or uncertainty are left out. Asymmetric errors are averaged.
+    stars = {}
+    star = None
+    with open(file, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            if row["star"].strip():
+                star = row["star"].strip()
+                stars[star] = {}
+            name = PARAMETERS.get(row["parameter"].strip())
+            if (star is None) or (name is None) or (name in stars[star]):
+                continue
+            if not (row["value"].strip() and row["error_min"].strip()):
+                continue
+
+            value = float(row["value"])
+            errors = [abs(float(row[key])) for key in ("error_min", "error_max") if row[key].strip()]
+            std = np.mean(errors)
+            unit = row["unit"].strip()
+            unit = UNIT_NAMES.get(unit, unit)
+
+            if unit == "log(Lsun)":
+                value, std = 10**value, np.log(10) * 10**value * std
+                unit = "Lsun"
+            elif name == "Lxray":
+                # the table lists X-ray luminosities in erg/s under a flux unit
+                unit = "erg/s"
+
+            stars[star][name] = np.array([value, std]) * u.Unit(unit)
+
+    return stars
+
+
+def star_dir_name(star):
+    return star.replace(" ", "_")
+
+
+class Job:
+
+    def __init__(self, name, args, after=None):
+
+        self.name = name
+        self.args = args
+        self.after = after or []
+        self.proc = None
+        self.log = None
+        self.status = "queued"
+
+
+def build_jobs(stars, configs, samplers, warm_start=None):
+
+    # warm_start: extra arguments of the design jobs
+    warm_start = warm_start or []
+    jobs = []
+    for star in stars:
+        design = Job("{} design".format(star), ["--star", star, "--stage", "design"] + warm_start)
+        jobs.append(design)
+        for config in configs:
+            train = Job("{} {} train".format(star, config),
+                        ["--star", star, "--stage", "train", "--config", config], after=[design])
+            jobs.append(train)
+            for sampler in samplers:
+                jobs.append(Job("{} {} {}".format(star, config, sampler),
+                                ["--star", star, "--stage", sampler, "--config", config], after=[train]))
+
+    return jobs
+
+
+def schedule(jobs, ncores, job_cores, log_dir, poll=5.):
+
+    # Start every job whose dependencies finished while enough cores are free
+    os.makedirs(log_dir, exist_ok=True)
+    slots = max(ncores // job_cores, 1)
+
+    while any(job.status in ("queued", "running") for job in jobs):
+        for job in jobs:
+            if (job.status == "running") and (job.proc.poll() is not None):
+                job.status = "done" if job.proc.returncode == 0 else "failed"
+                job.log.close()
+                print("[{}] {}".format(job.status, job.name), flush=True)
+
+            elif (job.status == "queued") and any(dep.status in ("failed", "skipped") for dep in job.after):
+                job.status = "skipped"
+                print("[skipped] {}".format(job.name), flush=True)
+
+        running = sum(job.status == "running" for job in jobs)
+        for job in jobs:
+            if running >= slots:
+                break
+            if (job.status == "queued") and all(dep.status == "done" for dep in job.after):
+                log_file = os.path.join(log_dir, job.name.replace(" ", "_") + ".log")
+                job.log = open(log_file, "w")
+                job.proc = subprocess.Popen([sys.executable, SCRIPT, "job", "--ncores", str(job_cores)] + job.args,
+                                            stdout=job.log, stderr=subprocess.STDOUT)
+                job.status = "running"
+                running += 1
+                print("[started] {} ({} cores, log {})".format(job.name, job_cores, log_file), flush=True)
+
+        time.sleep(poll)
+
+    return {job.name: job.status for job in jobs}
+
+
+def run_job(args):
+
+    # one stage for one star, in this process
+    import run_alabi
+
+    data = load_constraints(args.data)[args.star]
+    if ("mass" not in data) or ("Lbol" not in data):
+        raise ValueError("{} needs at least a mass and Lbol constraint".format(args.star))
+    run_alabi.configure_star(star_dir_name(args.star), data["mass"], data["Lbol"],
+                             Lxray=data.get("Lxray"), Prot=data.get("Prot"))
+
+    if args.stage == "design":
+        run_alabi.warm_start_sources = args.warm_start
+        run_alabi.warm_start_library = args.warm_start_library
+        run_alabi.run_initial_design(args.ncores)
+    elif args.config not in run_alabi.model_data:
+        raise ValueError("{} has no data for {}".format(args.star, args.config))
+    elif args.stage == "train":
+        run_alabi.train(args.config, args.ncores)
+    else:
+        run_alabi.sample(args.config, args.stage, args.ncores)
+
+
+if __name__ == '__main__':
+
+    if (len(sys.argv) > 1) and (sys.argv[1] == "job"):
+        parser = argparse.ArgumentParser(description="Run one batch job (started by batch_runner.py)")
+        parser.add_argument("job")
+        parser.add_argument("--star", required=True)
+        parser.add_argument("--stage", required=True, choices=["design", "train", "emcee", "dynesty"])
+        parser.add_argument("--config", default=None)
+        parser.add_argument("--ncores", type=int, required=True)
+        parser.add_argument("--data", default=DATA_FILE)
+        parser.add_argument("--warm-start", nargs="*", default=[])
+        parser.add_argument("--warm-start-library", type=int, default=0)
+        run_job(parser.parse_args())
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Run alabi for stars x configurations x samplers on a shared core budget")
+    parser.add_argument("--stars", nargs="+", default=None, help="star names in the data table (default: all)")
+    parser.add_argument("--configs", nargs="+", default=list(CONFIG_DATA.keys()), choices=list(CONFIG_DATA.keys()))
+    parser.add_argument("--samplers", nargs="+", default=["emcee", "dynesty"], choices=["emcee", "dynesty"])
+    parser.add_argument("--ncores", type=int, default=os.cpu_count(), help="total core budget")
+    parser.add_argument("--job-cores", type=int, default=None, help="cores per job (default: budget / number of stars)")
+    parser.add_argument("--data", default=DATA_FILE, help="literature constraints table")
+    parser.add_argument("--log-dir", default="results/batch_logs/")
+    parser.add_argument("--warm-start", nargs="+", default=[],
+                        help="stored evaluations to seed every star's design from (see warm_start.py)")
+    parser.add_argument("--warm-start-library", type=int, default=0,
+                        help="extra design points per star drawn on tracks in the track library")
+    args = parser.parse_args()
+
+    constraints = load_constraints(args.data)
+    stars = args.stars or list(constraints.keys())
+
+    # configurations a star has no data for are dropped, not run
+    runnable = []
+    for star in stars:
+        data = constraints[star]
+        if ("mass" not in data) or ("Lbol" not in data):
+            print("skipping {}: no mass or Lbol constraint".format(star))
+            continue
+        runnable.append(star)
+
+    jobs = []
+    for star in runnable:
+        configs = [config for config in args.configs
+                   if all(name in constraints[star] for name in CONFIG_DATA[config])]
+        warm_start = ["--warm-start-library", str(args.warm_start_library)]
+        if args.warm_start:
+            warm_start += ["--warm-start"] + args.warm_start
+        jobs += build_jobs([star], configs, args.samplers, warm_start=warm_start)
+
+    job_cores = args.job_cores or max(args.ncores // max(len(runnable), 1), 1)
+    status = schedule(jobs, args.ncores, job_cores, args.log_dir)
+
+    failed = [name for name, state in status.items() if state != "done"]
+    print("{} of {} jobs finished".format(len(status) - len(failed), len(status)))
+    if failed:
+        print("not finished:", ", ".join(failed))
+        sys.exit(1)
@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import numpy as np
+from astropy import units as u
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from johnstone_model import StellarEvolutionModel
+
+# Benchmarks of the model hot paths, run against stub_vplanet.py (a deterministic
+# stand-in for vplanet with a fixed, configurable latency) so results are comparable
+# across machines and commits:
+#
+#     python benchmark.py                      # run, save benchmark_results/<commit>.json
+#     python benchmark.py --compare benchmark_results/<baseline>.json
+#
+# Every result is a time in seconds (lower is better). --compare exits with status 1
+# when any result is slower than the baseline by more than --threshold.
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_vplanet.py")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results")
+
+j21 = {"beta1": (-0.135, 0.030),
+       "beta2": (-1.889, 0.079),
+       "Rosat": (0.0605, 0.00331),
+       "RXsat": (5.135e-4, 3.320e-5)}
+
+
+def make_model(**kwargs):
+
+    model = StellarEvolutionModel(star_name="benchmark",
+                                  Lbol_data=np.array([5.22e-4, 0.19e-4]) * u.Lsun,
+                                  Lxray_data=np.array([1.0e-7, 0.1e-7]) * u.Lsun,
+                                  Prot_data=np.array([3.295, 0.003]) * u.day,
+                                  **kwargs)
+    model.vpm.vplanet_exec = STUB
+    model.vpm.verbose = False
+
+    return model
+
+
+def sample_thetas(n, seed=0):
+
+    rng = np.random.default_rng(seed)
+    return np.array([rng.uniform(0.08, 0.6, n),
+                     rng.uniform(0.1, 12.0, n),
+                     rng.uniform(0.1, 12.0, n),
+                     rng.normal(*j21["beta1"], n),
+                     rng.normal(*j21["beta2"], n),
+                     rng.normal(*j21["Rosat"], n),
+                     rng.normal(*j21["RXsat"], n)]).T
+
+
+def best_of(fn, repeat):
+
+    # minimum wall time over repeat calls of fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_lxuv_model(args):
+
+    # one full LXUV_model evaluation (infile write, vplanet, parse, activity law)
+    model = make_model()
+    thetas = sample_thetas(args.repeat)
+    it = iter(thetas)
+
+    return {"lxuv_model": best_of(lambda: model.LXUV_model(next(it)), args.repeat)}
+
+
+def bench_sweep_scaling(args):
+
+    # run_parameter_sweep wall time per evaluation on 1, 2, 4, ... ncores
+    model = make_model()
+    results = {}
+
+    core_counts = sorted(set([2**ii for ii in range(int(np.log2(args.ncores)) + 1)] + [args.ncores]))
+    for ncores in core_counts:
+        thetas = sample_thetas(args.sweep_size, seed=ncores)
+        model.run_parameter_sweep(thetas[:ncores], ncores=ncores)     # pool start-up
+        start = time.perf_counter()
+        model.run_parameter_sweep(thetas, ncores=ncores)
+        results["sweep_per_eval_{}_cores".format(ncores)] = (time.perf_counter() - start) / len(thetas)
+
+    model.close_pool()
+    return results
+
+
+def bench_likelihood(args):
+
+    # chi-squared of one stored evolution, and the batched likelihood on a cached track
+    # (activity law and chi-squared only) per theta
+    model = make_model(cache_size=16)
+    theta = sample_thetas(1)[0]
+    evol = model.LXUV_model(theta)
+
+    nbatch = 1000
+    thetas = np.tile(theta, (nbatch, 1))
+    thetas[:, 3:] = sample_thetas(nbatch)[:, 3:]
+
+    return {"compute_chi_squared_fit": best_of(lambda: model.compute_chi_squared_fit(evol), args.repeat),
+            "lnlike_batch_per_theta": best_of(lambda: model.lnlike_batch(thetas), args.repeat) / nbatch}
+
+
+def bench_plot_evolution(args):
+
+    # plot_evolution for 10 / 100 / 1000 tracks (one evaluation, repeated)
+    model = make_model()
+    evol = model.LXUV_model(sample_thetas(1)[0])
+
+    results = {}
+    for ntrack in [10, 100, 1000]:
+        def plot():
+            fig = model.plot_evolution([evol] * ntrack, show=False)
+            plt.close(fig)
+        results["plot_evolution_{}".format(ntrack)] = best_of(plot, 1 if ntrack >= 1000 else args.repeat)
+
+    return results
+
+
+BENCHMARKS = {"lxuv_model": bench_lxuv_model,
+              "sweep": bench_sweep_scaling,
+              "likelihood": bench_likelihood,
+              "plot": bench_plot_evolution}
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def compare(results, baseline_file, threshold):
+
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)["results"]
+
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        ratio = value / baseline[name]
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print("{:<30} {:.3e} s   baseline {:.3e} s   x{:.2f}{}".format(name, value, baseline[name], ratio, flag))
+        if flag:
+            regressions.append(name)
+
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the stellar evolution model with a stub vplanet")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS.keys()), default=list(BENCHMARKS.keys()))
+    parser.add_argument("--latency", type=float, default=0.05, help="stub vplanet run time [s]")
+    parser.add_argument("--ncores", type=int, default=os.cpu_count(), help="largest pool size for sweep scaling")
+    parser.add_argument("--sweep-size", type=int, default=64, help="evaluations per sweep")
+    parser.add_argument("--repeat", type=int, default=5, help="repeats per timing (best is kept)")
+    parser.add_argument("--output", default=None, help="results file (default benchmark_results/<commit>.json)")
+    parser.add_argument("--compare", default=None, help="baseline results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    # inherited by every stub vplanet subprocess
+    os.environ["VPLANET_STUB_LATENCY"] = str(args.latency)
+
+    results = {}
+    for name in args.only:
+        print("running", name)
+        results.update(BENCHMARKS[name](args))
+
+    commit = git_commit()
+    record = {"commit": commit,
+              "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "machine": {"platform": platform.platform(),
+                          "python": platform.python_version(),
+                          "numpy": np.__version__,
+                          "cpu_count": os.cpu_count()},
+              "config": {"latency": args.latency,
+                         "ncores": args.ncores,
+                         "sweep_size": args.sweep_size,
+                         "repeat": args.repeat},
+              "results": results}
+
+    output = args.output or os.path.join(RESULTS_DIR, "{}.json".format(commit[:12]))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(record, f, indent=4)
+    print("saved", output)
+
+    if args.compare is not None:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            sys.exit(1)
+    else:
+        for name, value in results.items():
+            print("{:<30} {:.3e} s".format(name, value))
@@ -0,0 +1,229 @@
+import os
+import sys
+import glob
+import json
+import struct
+import zipfile
+import numpy as np
+
+__all__ = ["ReducedSamples", "autocorr_time", "reduce_chain", "reduce_samples", "reduce_sampler_output"]
+
+
+# Post-processing of sampler output. A long emcee run keeps nsteps x nwalkers x ndim
+# float64 values, while plots and posterior-predictive bands only need a few thousand
+# independent draws. The reduction stage estimates the integrated autocorrelation time
+# of the chain, discards burn-in, thins, and writes the rest as float32 chunks plus a
+# summary:
+#
+#     <savedir>/<sampler>_samples_reduced/
+#         summary.json        burn-in, thinning, tau, mean/std/quantiles per parameter
+#         chunk_0000.npy ...  (<= chunk_size, ndim) float32, memory-mappable
+#
+# Downstream code opens ReducedSamples(directory) instead of np.load-ing the raw chains.
+#
+# The raw chain is never loaded whole: it is read through a view (the sampler's chain)
+# or a memory map of the npz file, tau is estimated on at most max_steps evenly spaced
+# steps, and only the rows kept after burn-in and thinning are copied.
+
+
+def npz_memmap(file, key):
+
+    # Read-only memory map of array key in an uncompressed .npz (np.savez), or None
+    # when the member is compressed and has to be loaded
+    with zipfile.ZipFile(file) as zf:
+        info = zf.getinfo(key + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(file, "rb") as f:
+        # the member data follows its local file header (30 bytes, name, extra field)
+        f.seek(info.header_offset + 26)
+        name_len, extra_len = struct.unpack("<HH", f.read(4))
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    return np.memmap(file, dtype=dtype, mode="r", shape=shape, offset=offset,
+                     order="F" if fortran else "C")
+
+
+def load_samples(file, key="samples"):
+
+    # samples of a sampler output file, memory-mapped when possible
+    samples = npz_memmap(file, key)
+    if samples is None:
+        samples = np.load(file)[key]
+    return samples
+
+
+def autocorr_time(chain, c=5., max_steps=20000):
+
+    # Integrated autocorrelation time of each parameter of chain (nsteps, nwalkers, ndim):
+    # walker-averaged normalized autocorrelation function (FFT), summed up to Sokal's
+    # automatic window, the smallest M with M >= c * tau(M) (as in emcee.autocorr).
+    # Longer chains are estimated on every k-th step (at most max_steps of them) and tau
+    # scaled by k; for tau below k this overestimates it (at most k), which only makes
+    # the burn-in and thinning more conservative.
+    every = max(int(np.ceil(chain.shape[0] / max_steps)), 1)
+    nsteps = len(range(0, chain.shape[0], every))
+    nfft = 2**int(np.ceil(np.log2(2 * nsteps)))
+
+    tau = np.zeros(chain.shape[2])
+    for jj in range(chain.shape[2]):
+        # one parameter of the probed steps at a time
+        x = np.asarray(chain[::every, :, jj], dtype=float)
+        x = x - x.mean(axis=0)
+        f = np.fft.rfft(x, n=nfft, axis=0)
+        acf = np.fft.irfft(f * np.conjugate(f), axis=0)[:nsteps].mean(axis=1)
+        if acf[0] <= 0:
+            tau[jj] = 1.
+            continue
+        taus = 2.0 * np.cumsum(acf / acf[0]) - 1.0
+        window = np.arange(len(taus)) < c * taus
+        tau[jj] = taus[np.argmin(window)] if np.any(~window) else taus[-1]
+
+    return tau * every
+
+
+def reduce_chain(chain, burn_factor=2., thin_factor=0.5, max_samples=None):
+
+    # (flat samples, burn-in, thinning, tau) for chain (nsteps, nwalkers, ndim), which
+    # may be a view or memory map: burn_factor * max(tau) steps are discarded and every
+    # thin_factor * min(tau)-th step kept, thinned further if that would keep more than
+    # max_samples samples. Only the kept rows are read.
+    tau = autocorr_time(chain)
+    nsteps, nwalkers, ndim = chain.shape
+    burn = min(int(burn_factor * np.max(tau)), nsteps - 1)
+    thin = max(int(thin_factor * np.min(tau)), 1)
+    if max_samples is not None:
+        thin = max(thin, int(np.ceil((nsteps - burn) * nwalkers / max_samples)))
+    samples = np.array(chain[burn::thin]).reshape(-1, ndim)
+
+    return samples, burn, thin, tau
+
+
+class ReducedSamples:
+
+    # Thinned posterior samples stored as float32 chunks (see top of file)
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        with open(os.path.join(directory, "summary.json"), "r") as f:
+            self.summary = json.load(f)
+        self.files = sorted(glob.glob(os.path.join(directory, "chunk_*.npy")))
+        self.sizes = np.array([len(np.load(file, mmap_mode="r")) for file in self.files], dtype=int)
+
+    @classmethod
+    def write(cls, directory, samples, summary, chunk_size=100000):
+
+        # Replace any earlier reduction in directory; summary.json is written last, so a
+        # directory without it holds an interrupted write
+        os.makedirs(directory, exist_ok=True)
+        for file in glob.glob(os.path.join(directory, "chunk_*.npy")) + glob.glob(os.path.join(directory, "summary.json")):
+            os.remove(file)
+
+        samples = np.asarray(samples, dtype=np.float32)
+        for ii, start in enumerate(range(0, len(samples), chunk_size)):
+            np.save(os.path.join(directory, "chunk_{:04d}.npy".format(ii)), samples[start:start+chunk_size])
+
+        summary = dict(summary)
+        summary.update({"nsamples": len(samples), "ndim": samples.shape[1],
+                        "mean": samples.mean(axis=0).tolist(),
+                        "std": samples.std(axis=0).tolist(),
+                        "quantiles": {str(q): np.quantile(samples, q, axis=0).tolist() for q in (0.16, 0.5, 0.84)}})
+        tmp = os.path.join(directory, "summary.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(summary, f, indent=2)
+        os.replace(tmp, os.path.join(directory, "summary.json"))
+
+        return cls(directory)
+
+    def __len__(self):
+        return int(self.sizes.sum())
+
+    def load(self):
+
+        # every sample, (nsamples, ndim) float64
+        return np.concatenate([np.load(file) for file in self.files]).astype(float)
+
+    def draw(self, n, seed=None):
+
+        # n random samples without replacement, reading only the chunks they fall in
+        if n >= len(self):
+            return self.load()
+
+        rng = np.random.default_rng(seed)
+        index = np.sort(rng.choice(len(self), n, replace=False))
+        chunk = np.searchsorted(np.cumsum(self.sizes), index, side="right")
+        offsets = np.concatenate([[0], np.cumsum(self.sizes)[:-1]])
+
+        draws = []
+        for ii in np.unique(chunk):
+            data = np.load(self.files[ii], mmap_mode="r")
+            draws.append(np.asarray(data[index[chunk == ii] - offsets[ii]], dtype=float))
+
+        return np.concatenate(draws)
+
+
+def reduce_samples(directory, sampler, samples, nwalkers=None, chain=None, max_samples=None,
+                   burn_factor=2., thin_factor=0.5, chunk_size=100000, seed=0, source=None):
+
+    # Reduce one sampler's output and write it to directory; returns the ReducedSamples.
+    #
+    # emcee: chain (nsteps, nwalkers, ndim) if available (samples is then ignored), else
+    #        the flat samples, which get_chain(flat=True) orders step by step, reshaped
+    #        with nwalkers. Without either, the samples are kept as they are (no
+    #        autocorrelation estimate). Chains and samples may be views or memory maps.
+    # dynesty: nested samples have no burn-in; alabi's samples are already equally
+    #        weighted, so they are only subsampled to max_samples.
+    summary = {"sampler": sampler, "source": source, "burn": 0, "thin": 1, "tau": None}
+
+    if sampler == "emcee":
+        if (chain is None) and (nwalkers is not None) and (len(samples) % nwalkers == 0):
+            chain = samples.reshape(-1, nwalkers, samples.shape[-1])
+        if chain is not None:
+            samples, burn, thin, tau = reduce_chain(chain, burn_factor=burn_factor, thin_factor=thin_factor,
+                                                    max_samples=max_samples)
+            summary.update({"burn": burn, "thin": thin, "tau": tau.tolist(),
+                            "nsteps": int(np.shape(chain)[0]), "nwalkers": int(np.shape(chain)[1])})
+    elif sampler != "dynesty":
+        raise ValueError("unknown sampler {}; use 'emcee' or 'dynesty'".format(sampler))
+
+    if (max_samples is not None) and (len(samples) > max_samples):
+        rng = np.random.default_rng(seed)
+        samples = samples[np.sort(rng.choice(len(samples), max_samples, replace=False))]
+        summary["max_samples"] = max_samples
+
+    return ReducedSamples.write(directory, samples, summary, chunk_size=chunk_size)
+
+
+def reduce_sampler_output(savedir, sampler, sm=None, nwalkers=None, **kwargs):
+
+    # Reduce <savedir>/<sampler>_samples_final.npz (alabi's output), or the chain of the
+    # surrogate model's emcee sampler when sm is given, into <savedir>/<sampler>_samples_reduced/.
+    # get_chain() of emcee's in-memory backend is a view, and the npz is memory-mapped
+    chain = None
+    if (sm is not None) and (sampler == "emcee") and hasattr(getattr(sm, "sampler", None), "get_chain"):
+        chain = sm.sampler.get_chain()
+
+    source = os.path.join(savedir, "{}_samples_final.npz".format(sampler))
+    samples = load_samples(source) if chain is None else None
+
+    return reduce_samples(os.path.join(savedir, "{}_samples_reduced".format(sampler)), sampler, samples,
+                          nwalkers=nwalkers, chain=chain, source=source, **kwargs)
+
+
+if __name__ == '__main__':
+
+    # python chain_reduction.py <savedir> [nwalkers]: reduce existing sampler output
+    savedir = sys.argv[1]
+    nwalkers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    for sampler in ["emcee", "dynesty"]:
+        if os.path.exists(os.path.join(savedir, "{}_samples_final.npz".format(sampler))):
+            reduced = reduce_sampler_output(savedir, sampler, nwalkers=nwalkers)
+            print(sampler, len(reduced), "samples, burn", reduced.summary["burn"], "thin", reduced.summary["thin"])
@@ -1,11 +1,52 @@
+import os
 import numpy as np
 from astropy import units as u
-import matplotlib.pyplot as plt
 import multiprocessing as mp
+from collections import deque
 
-import vplanet_inference as vpi
+from vplanet_runner import VplanetRunner
+from track_cache import TrackCache
+from track_store import TrackStore, vplanet_version, infile_fingerprint
+from track_library import TrackLibrary
+from track_grid import TrackGrid
+from sweep_writer import SweepWriter
+from numpy_backend import NumpyStellarBackend
+from baraffe_table import BaraffeTable
+from stage_timer import StageTimer
 
-__all__ = ["StellarEvolutionModel"]
+__all__ = ["StellarEvolutionModel", "TrackNotAvailable"]
+
+# np.trapz was renamed np.trapezoid in NumPy 2.0 and removed later
+trapezoid = getattr(np, "trapezoid", None) or np.trapz
+
+
+class TrackNotAvailable(LookupError):
+
+    # raised by run_track in offline mode when a track would need a vplanet run
+    pass
+
+
+# Pool workers receive the model once, through the pool initializer (see get_pool), and
+# keep it in this global, so tasks only carry thetas and worker-side state (track
+# cache, grid, library index, scratch directory) persists across tasks.
+_worker_model = None
+
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+
+def _worker_sweep_chunk(start, thetas, units):
+    return _worker_model._run_sweep_chunk(start, thetas, units)
+
+
+def _worker_chi_squared(thetas):
+    return _worker_model.chi_squared_batch(thetas)
+
+
+def _worker_run_track(args):
+    return _worker_model.run_track(*args)
 
 
 class StellarEvolutionModel:
@@ -15,7 +56,22 @@ class StellarEvolutionModel:
                         Lxuv_data=None, 
                         Lxray_data=None,
                         Prot_data=None,
-                        age_data=None):
+                        age_data=None,
+                        cache_size=None,
+                        cache_bytes=None,
+                        cache_digits=6,
+                        store_dir=None,
+                        max_age=None,
+                        track_grid=None,
+                        scratch_dir=None,
+                        minimal_output=False,
+                        log_time_grid=None,
+                        backend="vplanet",
+                        baraffe_table=None,
+                        profile=False,
+                        library_dir=None,
+                        library_tolerance=(0.01, 0.02),
+                        library_mode="nearest"):
 
         self.star_name = star_name
 
@@ -56,9 +112,16 @@ class StellarEvolutionModel:
             self.age_data = None
             self.age_unit = u.Gyr
 
-        # Initialize the vplanet model with the input and output parameters
+        # Initialize the vplanet model with the input and output parameters.
+        # Each process runs vplanet in a private, reusable scratch directory under
+        # scratch_dir (default /dev/shm when available); outpath is only used for
+        # runs with remove=False.
+        # minimal_output=True makes vplanet write only the columns used here, and lets
+        # likelihood evaluations (chi_squared_batch) request only the final timestep;
+        # LXUV_model and parameter sweeps still get full tracks.
 
-        inpath = "../infiles/stellar/"
+        # templates are found relative to this file, not the working directory
+        inpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "infiles", "stellar")
         outpath = "output/"
 
         inparams = {"star.dMass": u.Msun,
@@ -70,15 +133,173 @@ class StellarEvolutionModel:
                     "final.star.RotPer": self.Prot_unit,
                     "final.star.RossbyNumber": u.dimensionless_unscaled}
 
-        self.vpm = vpi.VplanetModel(inparams=inparams,
-                            outparams=outparams,
-                            inpath=inpath,
-                            outpath=outpath,
-                            time_init=5e6*u.yr,
-                            timesteps=1e6*u.yr,
-                            verbose=True)
+        time_init = 5e6*u.yr
+        timesteps = 1e6*u.yr
+
+        # profile=True records the wall time of every stage of each evaluation (infile
+        # write, vplanet, parse, unit conversion, activity law, EUV relation, chi-squared,
+        # Quantity wrapping);
+        # read the aggregates with timing_stats() or write them with dump_timing(directory)
+
+        self.timer = StageTimer(enabled=profile)
+
+        # The VplanetRunner (templates, unit factors) is only built on the first vplanet
+        # run (see the vpm property), so constructing a model, importing scripts that
+        # define models and starting spawned pool workers stay cheap.
+
+        self._vpm_kwargs = dict(inparams=inparams,
+                                outparams=outparams,
+                                inpath=inpath,
+                                outpath=outpath,
+                                time_init=time_init,
+                                timesteps=timesteps,
+                                scratch_dir=scratch_dir,
+                                prune_outputs=minimal_output,
+                                verbose=True,
+                                timer=self.timer,
+                                time_unit=self.age_unit)
+        self._vpm = None
+
+        self.minimal_output = minimal_output
+
+        # If log_time_grid is set (points per decade), full tracks are resampled from
+        # vplanet's linear dOutputTime grid onto a log-spaced time grid before they are
+        # cached, stored or returned. vplanet itself only supports a fixed output step.
+
+        self.log_time_grid = log_time_grid
+
+        # Tracks and evolutions are handled internally as plain arrays in these units;
+        # conversion factors are resolved once here rather than on every evaluation
+
+        self.evol_units = {"Time": self.age_unit,
+                           "final.star.Luminosity": self.Lbol_unit,
+                           "final.star.Radius": u.Rsun,
+                           "final.star.RotPer": self.Prot_unit,
+                           "final.star.RossbyNumber": u.dimensionless_unscaled,
+                           "final.star.RossbyNumberScaled": u.dimensionless_unscaled,
+                           "final.star.RX": u.dimensionless_unscaled,
+                           "final.star.LXRAY": self.Lxray_unit,
+                           "final.star.LEUV": self.Lxuv_unit,
+                           "final.star.LXUV": self.Lxuv_unit}
+
+        self.yr_to_age = u.yr.to(self.age_unit)
+        self.lbol_to_cgs = self.Lbol_unit.to(u.erg / u.s)
+        self.rsun_to_cm = u.Rsun.to(u.cm)
+        self.lbol_to_lxray = self.Lbol_unit.to(self.Lxray_unit)
+        self.lbol_to_lxuv = self.Lbol_unit.to(self.Lxuv_unit)
+        self.cgs_to_lxuv = (u.erg / u.s).to(self.Lxuv_unit)
+        self.lsun_to_lbol = u.Lsun.to(self.Lbol_unit)
+        self.day_to_prot = u.day.to(self.Prot_unit)
+
+        # Optional memory-mapped Baraffe table (a BaraffeTable or the directory of one,
+        # built by baraffe_table.py). Lbol and radius depend only on (mass, age), so with
+        # a table, likelihoods with only Lbol/age data terms and prescreen never run vplanet.
+
+        self.time_init = time_init
+        if isinstance(baraffe_table, str):
+            baraffe_table = BaraffeTable(baraffe_table)
+        self.baraffe_table = baraffe_table
+
+        # backend="numpy" replaces the vplanet subprocess with the in-process
+        # NumpyStellarBackend, reading the structure from baraffe_table.
+        # Likelihood batches then evolve all of their uncached stars together
+        # in one lockstep integration.
+
+        if backend not in ("vplanet", "numpy"):
+            raise ValueError("unknown backend {}; use 'vplanet' or 'numpy'".format(backend))
+        self.backend = backend
+        if backend == "numpy":
+            if baraffe_table is None:
+                raise ValueError("backend='numpy' requires a baraffe_table")
+            self.numpy_backend = NumpyStellarBackend(baraffe_table, time_init=time_init.to(u.yr).value)
+        else:
+            self.numpy_backend = None
+
+        # Optional in-memory LRU cache of vplanet tracks, bounded by number of
+        # tracks (cache_size) and/or total array bytes (cache_bytes). Keys are the
+        # structural inputs rounded to cache_digits significant figures.
+        # Note that each multiprocessing worker holds its own copy of the cache.
+
+        self.cache_digits = cache_digits
+        if (cache_size is not None) or (cache_bytes is not None):
+            self.track_cache = TrackCache(max_size=cache_size, max_bytes=cache_bytes)
+        else:
+            self.track_cache = None
+
+        # If max_age is set (in age_unit), every (mass, Prot) track is run once to max_age
+        # and the observables at any requested age are interpolated from it, so the
+        # age parameter never triggers a new vplanet run
+
+        self.max_age = max_age
+
+        # Optional interpolating emulator backend: a TrackGrid (or the path to a saved one)
+        # built by track_grid.py. When set, evolve_track interpolates in (mass, Prot, age)
+        # instead of running vplanet
+
+        if isinstance(track_grid, str):
+            track_grid = TrackGrid.load(track_grid)
+        if track_grid is not None:
+            track_grid = track_grid.to_units(self.age_unit, self.evol_units)
+        self.track_grid = track_grid
+
+        # Optional on-disk track store shared by all processes and sessions. Its keys
+        # include a hash of the infile templates, the vplanet version and the model
+        # input/output configuration, so edited infiles never return stale tracks.
+        # Like vpm, it is opened on first use (looking up the vplanet version is slow).
+
+        self.store_dir = store_dir
+        self._store_config = (inpath, repr([inparams, outparams, time_init, timesteps,
+                                            "ndarray tracks", log_time_grid, backend,
+                                            repr(self.numpy_backend)]))
+        self._fingerprint = None
+        self._track_store = None
+
+        # Optional project-wide TrackLibrary shared by all stars: before running vplanet,
+        # run_track reuses the nearest stored track (or interpolates between stored tracks,
+        # library_mode="interpolate") within library_tolerance = (relative mass, ln Prot)
+        # of the request. Every new full track is added to the library.
+
+        self.library_dir = library_dir
+        self.library_tolerance = library_tolerance
+        self.library_mode = library_mode
+        self._track_library = None
+
+        # long-lived worker pool for parameter sweeps, created on first use
+        self._pool = None
+        self._pool_ncores = None
+
+        # offline=True never runs vplanet: tracks must come from the cache, the track
+        # store, the library, a grid or the numpy backend, otherwise run_track raises
+        # TrackNotAvailable (used to rescore stored evaluations, see warm_start.py)
+        self.offline = False
 
         
+    @property
+    def vpm(self):
+        if self._vpm is None:
+            self._vpm = VplanetRunner(**self._vpm_kwargs)
+        return self._vpm
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            inpath, config = self._store_config
+            self._fingerprint = infile_fingerprint(inpath, version=vplanet_version(), extra=config)
+        return self._fingerprint
+
+    @property
+    def track_store(self):
+        if (self._track_store is None) and (self.store_dir is not None):
+            self._track_store = TrackStore(self.store_dir, self.fingerprint)
+        return self._track_store
+
+    @property
+    def track_library(self):
+        if (self._track_library is None) and (self.library_dir is not None):
+            self._track_library = TrackLibrary(self.library_dir, self.fingerprint,
+                                               tolerance=self.library_tolerance, mode=self.library_mode)
+        return self._track_library
+
     # def luminosity_to_flux
     def luminosity_to_flux(self, luminosity, radius):
         return luminosity / (4 * np.pi * radius**2)
@@ -90,116 +311,599 @@ class StellarEvolutionModel:
     # def EUV_relation
     def EUV_relation(self, Lxray, radius):
 
-        Fxray = self.luminosity_to_flux(Lxray.cgs.value, radius.cgs.value)
-        log_FEUV1 = 2.04 + 0.681 * np.log10(Fxray)
-        FEUV1 = 10**log_FEUV1
-        log_FEUV2 = -0.341 + 0.920 * log_FEUV1
-        FEUV2 = 10**log_FEUV2
-        FEUV = (FEUV1 + FEUV2) * u.erg / u.s / u.cm**2
+        # Quantity inputs return a Quantity; plain inputs are taken in cgs
+        # (erg/s and cm) and return LEUV in erg/s without any unit handling
+
+        if isinstance(Lxray, u.Quantity):
+            LEUV = self.EUV_relation(Lxray.cgs.value, radius.cgs.value)
+            return LEUV * u.erg / u.s
+
+        with self.timer.stage("EUV_relation"):
+            Fxray = self.luminosity_to_flux(Lxray, radius)
+            log_FEUV1 = 2.04 + 0.681 * np.log10(Fxray)
+            FEUV1 = 10**log_FEUV1
+            log_FEUV2 = -0.341 + 0.920 * log_FEUV1
+            FEUV2 = 10**log_FEUV2
+            FEUV = FEUV1 + FEUV2
+
+            return self.flux_to_luminosity(FEUV, radius)
+
+    # def track_key
+    def track_key(self, mstar, prot, age):
+        return tuple(float("{:.{}g}".format(float(x), self.cache_digits)) for x in (mstar, prot, age))
+
+    # def timing_stats
+    def timing_stats(self):
+        if not self.timer.enabled:
+            return None
+        return self.timer.stats()
+
+    # def dump_timing
+    def dump_timing(self, directory):
+        return self.timer.dump(directory)
+
+    # def cache_stats
+    def cache_stats(self):
+        if self.track_cache is None:
+            return None
+        return self.track_cache.stats()
+
+    # def library_stats
+    def library_stats(self):
+        if self.track_library is None:
+            return None
+        return self.track_library.stats()
+
+    # def evolve_track
+    def evolve_track(self, mstar, prot, age, remove=True, final_only=False):
+
+        # Only the structural parameters (mass, initial Prot, age) enter the vplanet run;
+        # the activity law is applied to the returned track by activity_model.
+        # Returned tracks may be shared through the cache and should not be modified.
+        # final_only=True only guarantees the last row (used for likelihoods); it is
+        # ignored when tracks are interpolated from a grid or a max_age run.
+
+        if self.track_grid is not None:
+            return self.track_grid.track(mstar, prot, age)
+
+        if self.max_age is not None:
+            if age > self.max_age:
+                raise ValueError("age {} exceeds max_age {}".format(age, self.max_age))
+            track = self.run_track(mstar, prot, self.max_age, remove=remove)
+            return self.truncate_track(track, age)
+
+        return self.run_track(mstar, prot, age, remove=remove, final_only=final_only)
+
+    # def run_track
+    def run_track(self, mstar, prot, age, remove=True, final_only=False):
+
+        key = self.track_key(mstar, prot, age)
+        track = self.lookup_track(key, mstar, prot, age, final_only=final_only)
+        if track is not None:
+            return track
+
+        if self.numpy_backend is not None:
+            # the backend always integrates the full track
+            track = self.backend_track(self.numpy_backend.evolve(mstar, prot / self.day_to_prot,
+                                                                 age / self.yr_to_age)[0])
+            return self.save_track(key, track)
+
+        if self.offline:
+            raise TrackNotAvailable("no stored track for (mass, Prot, age) = {}".format(key))
+
+        track = self.vpm.run_model(np.array([mstar, prot, age]), remove=remove, units=False,
+                                   final_only=final_only)
 
-        return self.flux_to_luminosity(FEUV, radius)
+        # adjust by scale factor to be consistent with Johnstone model 
+        track["final.star.RossbyNumberScaled"] = track["final.star.RossbyNumber"] * .95/2.11
 
-    # def LXUV_model
+        if final_only:
+            key = key + ("final",)
+        return self.save_track(key, track, final_only=final_only)
 
-    def LXUV_model(self, theta, remove=True):
+    # def lookup_track
+    def lookup_track(self, key, mstar, prot, age, final_only=False):
 
-        mstar, prot, age, beta1, beta2, Rosat, RXsat = theta
+        # Track for key without computing one, or None. Final-only tracks are cached and
+        # stored separately, but a cached or stored full track also answers a final-only
+        # request; the library is the last resort (approximate reuse of another run).
+        track = self.stored_track(key)
+        if (track is None) and final_only:
+            track = self.stored_track(key + ("final",))
 
-        # Run the vplanet model with the input parameters
+        if (track is None) and (self.track_library is not None):
+            track = self.track_library.lookup(mstar, prot, age, self.truncate_track)
+            if (track is not None) and (self.track_cache is not None):
+                self.track_cache.put(key, track)
 
-        evol = self.vpm.run_model(np.array([mstar, prot, age]), remove=remove)
+        return track
 
-        # adjust by scale factor to be consistent with Johnstone model 
-        evol["final.star.RossbyNumberScaled"] = evol["final.star.RossbyNumber"] * .95/2.11
-        ross = evol["final.star.RossbyNumberScaled"] 
-        lbol = evol["final.star.Luminosity"]
-        radius = evol["final.star.Radius"]
+    # def stored_track
+    def stored_track(self, key):
 
-        C1 = RXsat / Rosat**beta1
-        C2 = RXsat / Rosat**beta2
-        
-        rx = np.zeros(len(ross))
-        for ii in range(len(ross)):
-            if ross[ii] < Rosat:
-                rx[ii] = C1 * ross[ii]**beta1
+        # track for key from the LRU cache or the track store, or None
+        if self.track_cache is not None:
+            track = self.track_cache.get(key)
+            if track is not None:
+                return track
+
+        if self.track_store is None:
+            return None
+
+        # zero-copy memory map unless the track will be held in the LRU cache
+        track = self.track_store.get(key, mmap=(self.track_cache is None))
+        if (track is not None) and (self.track_cache is not None):
+            self.track_cache.put(key, track)
+
+        return track
+
+    # def save_track
+    def save_track(self, key, track, final_only=False):
+
+        # Resample a newly computed track onto the log time grid and keep it in the
+        # track store, the library (full tracks only) and the cache
+        if (self.log_time_grid is not None) and (not final_only):
+            track = self.resample_track(track, self.log_time_grid)
+
+        if self.track_store is not None:
+            self.track_store.put(key, track)
+        if (self.track_library is not None) and (not final_only):
+            self.track_library.add(key, track)
+        if self.track_cache is not None:
+            self.track_cache.put(key, track)
+
+        return track
+
+    # def backend_track
+    def backend_track(self, raw):
+
+        # NumpyStellarBackend track (yr, Lsun, Rsun, days) -> run_track format in evol_units
+        track = {"Time": raw["Time"] * self.yr_to_age,
+                 "final.star.Luminosity": raw["Luminosity"] * self.lsun_to_lbol,
+                 "final.star.Radius": raw["Radius"],
+                 "final.star.RotPer": raw["RotPer"] * self.day_to_prot,
+                 "final.star.RossbyNumber": raw["RossbyNumber"]}
+        track["final.star.RossbyNumberScaled"] = track["final.star.RossbyNumber"] * .95/2.11
+
+        return track
+
+    # def evolve_tracks
+    def evolve_tracks(self, structural, final_only=False):
+
+        # evolve_track for each (mass, Prot, age) row. With the numpy backend, every
+        # distinct track not found by lookup_track is integrated once, all of them in a
+        # single lockstep batch, and saved exactly as run_track would save it.
+
+        structural = np.atleast_2d(np.asarray(structural, dtype=float))
+        if (self.numpy_backend is None) or (self.track_grid is not None):
+            return [self.evolve_track(*row, final_only=final_only) for row in structural]
+
+        if self.max_age is not None:
+            if np.any(structural[:, 2] > self.max_age):
+                raise ValueError("age {} exceeds max_age {}".format(structural[:, 2].max(), self.max_age))
+            run_ages = np.full(len(structural), float(self.max_age))
+        else:
+            run_ages = structural[:, 2]
+
+        keys = [self.track_key(mstar, prot, age) for (mstar, prot, _), age in zip(structural, run_ages)]
+
+        found, todo = {}, {}
+        for ii, key in enumerate(keys):
+            if (key in found) or (key in todo):
+                continue
+            track = self.lookup_track(key, structural[ii, 0], structural[ii, 1], run_ages[ii],
+                                      final_only=final_only)
+            if track is not None:
+                found[key] = track
             else:
-                rx[ii] = C2 * ross[ii]**beta2
+                todo[key] = ii
+
+        if len(todo) > 0:
+            idx = list(todo.values())
+            raw = self.numpy_backend.evolve(structural[idx, 0], structural[idx, 1] / self.day_to_prot,
+                                            run_ages[idx] / self.yr_to_age)
+            for key, track in zip(todo.keys(), raw):
+                found[key] = self.save_track(key, self.backend_track(track))
+
+        if self.max_age is None:
+            return [found[key] for key in keys]
+
+        return [self.truncate_track(found[key], row[2]) for key, row in zip(keys, structural)]
+
+    # def resample_track
+    def resample_track(self, track, points_per_decade):
+
+        # Interpolate a track (linearly in log time) onto a log-spaced time grid with
+        # points_per_decade points, keeping an initial t=0 row and the exact final row
+
+        time = track["Time"]
+        start = 1 if time[0] <= 0 else 0
+        ndecade = np.log10(time[-1] / time[start])
+        npoints = max(int(np.ceil(ndecade * points_per_decade)) + 1, 2)
+
+        log_time = np.linspace(np.log10(time[start]), np.log10(time[-1]), npoints)
+        new_time = np.concatenate([time[:start], 10**log_time])
+        new_time[-1] = time[-1]
+
+        resampled = {"Time": new_time}
+        for name, val in track.items():
+            if name != "Time":
+                resampled[name] = np.concatenate([val[:start], np.interp(log_time, np.log10(time[start:]), val[start:])])
+
+        return resampled
+
+    # def truncate_track
+    def truncate_track(self, track, age):
+
+        # Cut a track down to end at age (in age_unit), linearly interpolating
+        # every output at exactly that age for the final row
+
+        time = track["Time"]
+        nkeep = np.searchsorted(time, age, side="left")
+
+        truncated = {}
+        for name, val in track.items():
+            truncated[name] = np.append(val[:nkeep], np.interp(age, time, val))
+
+        return truncated
+
+    # def activity_model
+    def activity_model(self, track, activity_params):
+
+        # activity_params = (beta1, beta2, Rosat, RXsat), or an array of shape (n, 4)
+        # to evaluate n activity-law draws on the same track at once.
+        # Outputs have shape (n, ntime), or (ntime,) for a single parameter vector
+
+        with self.timer.stage("activity_law"):
+            activity_params = np.asarray(activity_params, dtype=float)
+            params = np.atleast_2d(activity_params)
+            beta1, beta2, Rosat, RXsat = [params[:, ii, None] for ii in range(4)]
+
+            ross = track["final.star.RossbyNumberScaled"][None, :]
+            lbol = track["final.star.Luminosity"]
+            radius = track["final.star.Radius"] * self.rsun_to_cm
+
+            C1 = RXsat / Rosat**beta1
+            C2 = RXsat / Rosat**beta2
+
+            rx = np.where(ross < Rosat, C1 * ross**beta1, C2 * ross**beta2)
+
+            # plain arrays in evol_units
+            rx_lbol = rx * lbol
+            leuv = self.EUV_relation(rx_lbol * self.lbol_to_cgs, radius) * self.cgs_to_lxuv
+
+            activity = {}
+            activity["final.star.RX"] = rx
+            activity["final.star.LXRAY"] = rx_lbol * self.lbol_to_lxray
+            activity["final.star.LEUV"] = leuv
+            activity["final.star.LXUV"] = rx_lbol * self.lbol_to_lxuv + leuv
+
+            if activity_params.ndim == 1:
+                activity = {key: val[0] for key, val in activity.items()}
 
-        evol["final.star.RX"] = rx
-        evol["final.star.LXRAY"] = rx * lbol
+        return activity
 
-        evol["final.star.LEUV"] = self.EUV_relation(evol["final.star.LXRAY"], radius)
-        evol["final.star.LXUV"] = evol["final.star.LXRAY"] + evol["final.star.LEUV"]
+    # def with_units
+    def with_units(self, evol):
+        return {name: val * self.evol_units[name] for name, val in evol.items()}
 
-        evol["final.star.LXRAY"] = evol["final.star.LXRAY"].to(self.Lxray_unit)
-        evol["final.star.LEUV"] = evol["final.star.LEUV"].to(self.Lxuv_unit)
-        evol["final.star.LXUV"] = evol["final.star.LXUV"].to(self.Lxuv_unit)
+    # def fluence
+    def fluence(self, evol, name="final.star.LXUV"):
 
-        evol["Time"] = evol["Time"].to(self.age_unit)
-        evol["final.star.RotPer"] = evol["final.star.RotPer"].to(self.Prot_unit)
+        # time-integrated luminosity of an evolution (e.g. the XUV fluence), in erg
+        time = getattr(evol["Time"], "value", evol["Time"])
+        lum = getattr(evol[name], "value", evol[name])
+        factor = (self.evol_units[name] * self.evol_units["Time"]).to(u.erg)
+
+        return trapezoid(lum, time, axis=-1) * factor * u.erg
+
+    # def LXUV_model
+
+    def LXUV_model(self, theta, remove=True, units=True):
+
+        mstar, prot, age, beta1, beta2, Rosat, RXsat = theta
+
+        # Run the vplanet model with the structural parameters, then apply the activity law.
+        # Everything is computed on plain arrays in evol_units; units=True wraps the
+        # returned evolution as Quantities, units=False returns the arrays directly
+
+        evol = dict(self.evolve_track(mstar, prot, age, remove=remove))
+        evol.update(self.activity_model(evol, [beta1, beta2, Rosat, RXsat]))
         self.evol = evol 
 
+        if units:
+            with self.timer.stage("quantities"):
+                return self.with_units(evol)
         return evol
 
     # def compute_chi_squared_fit (inputs: data)
-    def compute_chi_squared_fit(self):
+    def compute_chi_squared_fit(self, evol=None):
 
-        chi_squared = []
+        # evol defaults to the one stored by the last LXUV_model call; pass it
+        # explicitly (or use lnlike_batch) to avoid relying on that shared state
 
-        if self.Lbol_data is not None:
-            final_lbol = self.evol["final.star.Luminosity"].value[-1]
-            Lbol_data_mean = self.Lbol_data[0]
-            Lbol_data_std = self.Lbol_data[1]
+        if evol is None:
+            evol = self.evol
+        evol = {name: getattr(val, "value", val) for name, val in evol.items()}
 
-            chi_squared_lbol = (final_lbol - Lbol_data_mean)**2 / Lbol_data_std**2
-            chi_squared.append(chi_squared_lbol)
+        with self.timer.stage("chi_squared"):
+            chi_squared = []
 
-        if self.Lxuv_data is not None:
-            final_lxuv = self.evol["final.star.LXUV"].value[-1]
-            LXUV_data_mean = self.Lxuv_data[0]
-            LXUV_data_std = self.Lxuv_data[1]
+            if self.Lbol_data is not None:
+                final_lbol = evol["final.star.Luminosity"][-1]
+                Lbol_data_mean = self.Lbol_data[0]
+                Lbol_data_std = self.Lbol_data[1]
 
-            chi_squared_lxuv = (final_lxuv - LXUV_data_mean)**2 / LXUV_data_std**2
-            chi_squared.append(chi_squared_lxuv)
+                chi_squared_lbol = (final_lbol - Lbol_data_mean)**2 / Lbol_data_std**2
+                chi_squared.append(chi_squared_lbol)
 
-        if self.Lxray_data is not None:
-            final_lxray = self.evol["final.star.LXRAY"].value[-1]
-            Lxray_data_mean = self.Lxray_data[0]
-            Lxray_data_std = self.Lxray_data[1]
+            if self.Lxuv_data is not None:
+                final_lxuv = evol["final.star.LXUV"][-1]
+                LXUV_data_mean = self.Lxuv_data[0]
+                LXUV_data_std = self.Lxuv_data[1]
 
-            chi_squared_xray = (final_lxray - Lxray_data_mean)**2 / Lxray_data_std**2
-            chi_squared.append(chi_squared_xray)
+                chi_squared_lxuv = (final_lxuv - LXUV_data_mean)**2 / LXUV_data_std**2
+                chi_squared.append(chi_squared_lxuv)
 
-        if self.Prot_data is not None:
-            final_prot = self.evol["final.star.RotPer"].value[-1]
-            Prot_data_mean = self.Prot_data[0]
-            Prot_data_std = self.Prot_data[1]
+            if self.Lxray_data is not None:
+                final_lxray = evol["final.star.LXRAY"][-1]
+                Lxray_data_mean = self.Lxray_data[0]
+                Lxray_data_std = self.Lxray_data[1]
 
-            chi_squared_prot = (final_prot - Prot_data_mean)**2 / Prot_data_std**2
-            chi_squared.append(chi_squared_prot)
+                chi_squared_xray = (final_lxray - Lxray_data_mean)**2 / Lxray_data_std**2
+                chi_squared.append(chi_squared_xray)
 
-        if self.age_data is not None:
-            final_age = self.evol["Time"].value[-1]
-            age_data_mean = self.age_data[0]
-            age_data_std = self.age_data[1]
+            if self.Prot_data is not None:
+                final_prot = evol["final.star.RotPer"][-1]
+                Prot_data_mean = self.Prot_data[0]
+                Prot_data_std = self.Prot_data[1]
+
+                chi_squared_prot = (final_prot - Prot_data_mean)**2 / Prot_data_std**2
+                chi_squared.append(chi_squared_prot)
 
-            chi_squared_age = (final_age - age_data_mean)**2 / age_data_std**2
-            chi_squared.append(chi_squared_age)
+            if self.age_data is not None:
+                final_age = evol["Time"][-1]
+                age_data_mean = self.age_data[0]
+                age_data_std = self.age_data[1]
+
+                chi_squared_age = (final_age - age_data_mean)**2 / age_data_std**2
+                chi_squared.append(chi_squared_age)
 
         return np.array(chi_squared)
 
+    # def data_terms
+    def data_terms(self):
+
+        # (evol key, [mean, std]) for each configured data term, in the same order
+        # as compute_chi_squared_fit
+
+        terms = []
+        if self.Lbol_data is not None:
+            terms.append(("final.star.Luminosity", self.Lbol_data))
+        if self.Lxuv_data is not None:
+            terms.append(("final.star.LXUV", self.Lxuv_data))
+        if self.Lxray_data is not None:
+            terms.append(("final.star.LXRAY", self.Lxray_data))
+        if self.Prot_data is not None:
+            terms.append(("final.star.RotPer", self.Prot_data))
+        if self.age_data is not None:
+            terms.append(("Time", self.age_data))
+
+        return terms
+
+    # def chi_squared_batch
+    def chi_squared_batch(self, thetas):
+
+        # Chi-squared of every data term for a batch of thetas, shape (n, nterms).
+        # Nothing is stored on the model: thetas sharing the same (mass, Prot, age)
+        # share one track, and the activity law is evaluated only at the final age.
+
+        thetas = np.atleast_2d(np.asarray(thetas, dtype=float))
+        terms = self.data_terms()
+        chi_squared = np.zeros((len(thetas), len(terms)))
+
+        if self.structure_only():
+            # no rotation-dependent terms: vectorized Baraffe table lookup, no tracks
+            for jj, (name, data) in enumerate(terms):
+                if name == "Time":
+                    chi_squared[:, jj] = (thetas[:, 2] - data[0])**2 / data[1]**2
+                else:
+                    chi_squared[:, jj] = self.lbol_chi_squared(thetas)
+            return chi_squared
+
+        groups = {}
+        for ii, theta in enumerate(thetas):
+            groups.setdefault(self.track_key(*theta[:3]), []).append(ii)
+
+        groups = list(groups.values())
+        tracks = self.evolve_tracks(thetas[[idx[0] for idx in groups], :3], final_only=self.minimal_output)
+
+        for idx, track in zip(groups, tracks):
+
+            final = {name: val[-1:] for name, val in track.items()}
+            final.update(self.activity_model(final, thetas[idx, 3:]))
+
+            with self.timer.stage("chi_squared"):
+                for jj, (name, data) in enumerate(terms):
+                    model_final = np.atleast_2d(final[name])[:, -1]
+                    chi_squared[idx, jj] = (model_final - data[0])**2 / data[1]**2
+
+        return chi_squared
+
+    # def lbol_radius
+    def lbol_radius(self, mstar, age):
+
+        # Lbol (Lbol_unit) and radius (Rsun) from the Baraffe table, vectorized over
+        # mstar and age (in age_unit, counted from the start of the run like Time)
+        if self.baraffe_table is None:
+            raise ValueError("lbol_radius requires a baraffe_table")
+
+        stellar_age = np.asarray(age, dtype=float) / self.yr_to_age + self.time_init.to(u.yr).value
+        lbol, radius = self.baraffe_table.lbol_radius(mstar, stellar_age)
+
+        return lbol * self.lsun_to_lbol, radius
+
+    # def structure_only
+    def structure_only(self):
+
+        # True when every data term can be evaluated from the Baraffe table alone
+        names = [name for name, _ in self.data_terms()]
+        return (self.baraffe_table is not None) and all(name in ("final.star.Luminosity", "Time") for name in names)
+
+    # def lbol_chi_squared
+    def lbol_chi_squared(self, thetas):
+
+        # chi-squared of the Lbol data alone for a batch of thetas, shape (n,)
+        thetas = np.atleast_2d(np.asarray(thetas, dtype=float))
+        lbol, _ = self.lbol_radius(thetas[:, 0], thetas[:, 2])
+
+        return (lbol - self.Lbol_data[0])**2 / self.Lbol_data[1]**2
+
+    # def prescreen
+    def prescreen(self, thetas, nsigma=5):
+
+        # Boolean mask of thetas whose Baraffe Lbol is within nsigma of the Lbol data,
+        # i.e. those worth a full evolution
+        return self.lbol_chi_squared(thetas) <= nsigma**2
+
+    # def lnlike_batch
+    def lnlike_batch(self, thetas):
+        return -0.5 * np.sum(self.chi_squared_batch(thetas), axis=1)
+
 
     # def run_parameter_sweep (inputs: thetas, num_samples, etc)
-    def run_parameter_sweep(self, thetas, ncores=mp.cpu_count()):
+    def run_parameter_sweep(self, thetas, ncores=mp.cpu_count(), chunksize=1):
 
-        pool = mp.Pool(ncores)
-        evols = pool.map(self.LXUV_model, thetas)
-        pool.close()
+        evols = [None] * len(thetas)
+        for ii, evol in self.iter_parameter_sweep(thetas, ncores=ncores, chunksize=chunksize):
+            evols[ii] = evol
 
         return evols
+
+    # def run_checkpointed_sweep
+    def run_checkpointed_sweep(self, thetas, save_dir, ncores=mp.cpu_count(), chunksize=1,
+                               shard_size=50, flush_interval=10.):
+
+        # Sweep that streams each finished evolution (as plain arrays in evol_units)
+        # to npz shards in save_dir (see SweepWriter for when shards are written;
+        # shard_size=1 writes every result as it arrives). Re-running with the same
+        # thetas and save_dir skips every theta that already completed. Returns the
+        # SweepWriter, which can be iterated to read the results back one shard at a time.
+
+        thetas = np.asarray(thetas, dtype=float)
+        writer = SweepWriter(save_dir, thetas, self.evol_units, shard_size=shard_size,
+                             flush_interval=flush_interval)
+        todo = writer.remaining()
+
+        try:
+            for ii, evol in self.iter_parameter_sweep(thetas[todo], ncores=ncores, chunksize=chunksize,
+                                                      ordered=False, units=False):
+                writer.append(todo[ii], evol)
+        finally:
+            writer.close()
+
+        return writer
+
+    # def iter_parameter_sweep
+    def iter_parameter_sweep(self, thetas, ncores=mp.cpu_count(), chunksize=1,
+                             max_in_flight=None, ordered=True, units=True):
+
+        # Generator over (index, evol) for each theta, evaluated on the model's
+        # persistent pool. At most max_in_flight chunks (default 2 * ncores) are
+        # queued at once. ordered=False yields chunks as soon as they finish.
+
+        pool = self.get_pool(ncores)
+        if max_in_flight is None:
+            max_in_flight = 2 * ncores
+
+        pending = deque()
+        for start in range(0, len(thetas), chunksize):
+            chunk = thetas[start:start+chunksize]
+            pending.append(pool.apply_async(_worker_sweep_chunk, (start, chunk, units)))
+
+            while len(pending) >= max_in_flight:
+                yield from self._next_sweep_chunk(pending, ordered)
+
+        while pending:
+            yield from self._next_sweep_chunk(pending, ordered)
+
+    def _next_sweep_chunk(self, pending, ordered):
+
+        if ordered:
+            result = pending.popleft()
+        else:
+            result = None
+            while result is None:
+                for res in pending:
+                    if res.ready():
+                        result = res
+                        break
+                else:
+                    pending[0].wait(0.05)
+            pending.remove(result)
+
+        start, evols, timings = result.get()
+        self.timer.merge(timings)
+        for ii, evol in enumerate(evols):
+            yield start + ii, evol
+
+    def _run_sweep_chunk(self, start, thetas, units=True):
+
+        # worker-side stage timings are returned with each chunk and merged by the parent
+        self.timer.reset()
+        evols = [self.LXUV_model(theta, units=units) for theta in thetas]
+        return start, evols, self.timer.stats()
+
+    # def map_chi_squared
+    def map_chi_squared(self, chunks, ncores=mp.cpu_count()):
+
+        # chi_squared_batch of each chunk of thetas on the pool, in order
+        return self.get_pool(ncores).imap(_worker_chi_squared, chunks)
+
+    # def map_tracks
+    def map_tracks(self, structural, ncores=mp.cpu_count()):
+
+        # run_track for each (mass, Prot, age) row on the pool
+        return self.get_pool(ncores).map(_worker_run_track, [tuple(row) for row in structural])
+
+    # def get_pool
+    def get_pool(self, ncores=mp.cpu_count()):
+
+        # Workers hold a copy of the model as it was when the pool started;
+        # call close_pool() after changing the model's configuration
+        if (self._pool is None) or (self._pool_ncores != ncores):
+            self.close_pool()
+            self._pool = mp.Pool(ncores, initializer=_init_worker, initargs=(self,))
+            self._pool_ncores = ncores
+
+        return self._pool
+
+    # def close_pool
+    def close_pool(self):
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._pool_ncores = None
+
+    def __getstate__(self):
+
+        # the pool stays with the parent process when the model is sent to workers
+        # (once per worker, see get_pool), and workers start from an empty track
+        # cache rather than a pickled copy
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        state["_pool_ncores"] = None
+        if self.track_cache is not None:
+            state["track_cache"] = TrackCache(max_size=self.track_cache.max_size,
+                                              max_bytes=self.track_cache.max_bytes)
+        return state
     
     def plot_evolution(self, evols, show=True):
 
+        import matplotlib.pyplot as plt
+
         fig, axs = plt.subplots(3, 1, figsize=[10,14], sharex=True)
 
         for evol in evols:
@@ -0,0 +1,228 @@
+import numpy as np
+import multiprocessing as mp
+from astropy import units as u
+
+__all__ = ["PosteriorBands", "BandAccumulator", "posterior_bands"]
+
+
+# evolution outputs summarized by the bands, and their short names
+QUANTITIES = {"final.star.Luminosity": "Lbol",
+              "final.star.LXRAY": "LXRAY",
+              "final.star.LXUV": "LXUV",
+              "final.star.RotPer": "Prot"}
+
+
+class PosteriorBands:
+
+    # Compact posterior-predictive summary: for each quantity, the quantiles (default
+    # 16/50/84%) across posterior samples at every time in times, and the number of
+    # samples whose evolution reached that time. Saved and loaded as a small npz.
+
+    def __init__(self, times, quantiles, values, counts, units, time_unit):
+
+        # values: {short name: array (nquantile, ntime)}, counts: array (ntime,)
+        self.times = np.asarray(times, dtype=float)
+        self.quantiles = np.asarray(quantiles, dtype=float)
+        self.values = values
+        self.counts = np.asarray(counts)
+        self.units = units
+        self.time_unit = u.Unit(time_unit)
+
+    def band(self, name, quantile):
+
+        # values of one quantile (e.g. 0.5) across time, as a Quantity
+        ii = np.argmin(np.abs(self.quantiles - quantile))
+        return self.values[name][ii] * u.Unit(self.units[name])
+
+    def save(self, file):
+
+        arrays = {"band." + name: val for name, val in self.values.items()}
+        np.savez(file, times=self.times, quantiles=self.quantiles, counts=self.counts,
+                 names=np.array(list(self.values.keys())),
+                 units=np.array([self.units[name] for name in self.values.keys()]),
+                 time_unit=np.array(self.time_unit.to_string()), **arrays)
+
+    @classmethod
+    def load(cls, file):
+
+        with np.load(file) as data:
+            names = [str(name) for name in data["names"]]
+            units = dict(zip(names, [str(unit) for unit in data["units"]]))
+            values = {name: data["band." + name] for name in names}
+            return cls(data["times"], data["quantiles"], values, data["counts"], units,
+                       str(data["time_unit"]))
+
+    def plot(self, model=None, show=True, color="k", min_count=1):
+
+        # Lbol, LXRAY / LXUV and Prot bands in the layout of plot_evolution; with a model,
+        # its data are overplotted the same way
+        import matplotlib.pyplot as plt
+
+        fig, axs = plt.subplots(3, 1, figsize=[10,14], sharex=True)
+        panels = [(axs[0], "Lbol"), (axs[1], "LXRAY"), (axs[1], "LXUV"), (axs[2], "Prot")]
+        keep = self.counts >= min_count
+        time = self.times[keep]
+
+        for ax, name in panels:
+            if name not in self.values:
+                continue
+            lo, mid, hi = [self.values[name][ii][keep] for ii in (0, len(self.quantiles) // 2, -1)]
+            style = "--" if name == "LXUV" else "-"
+            ax.fill_between(time, lo, hi, color=color, alpha=0.2, lw=0)
+            ax.plot(time, mid, color=color, linestyle=style, label=name)
+
+        labels = ["Bolometric Luminosity [{}]", "Xray Luminosity [{}]", "Rotation Period [{}]"]
+        for ax, label, name in zip(axs, labels, ["Lbol", "LXRAY", "Prot"]):
+            ax.set_ylabel(label.format(self.units.get(name, "")), fontsize=20)
+            ax.set_xlabel("Time [{}]".format(self.time_unit), fontsize=20)
+            ax.set_xscale('log')
+            ax.set_yscale('log')
+        axs[1].legend(fontsize=14)
+
+        if model is not None:
+            axs[0].set_title(model.star_name, fontsize=24)
+            for ax, data in [(axs[0], model.Lbol_data), (axs[1], model.Lxuv_data),
+                             (axs[1], model.Lxray_data), (axs[2], model.Prot_data)]:
+                if data is not None:
+                    ax.axhline(data[0], color="r", linestyle="--")
+                    ax.axhspan(data[0]-data[1], data[0]+data[1], color="r", alpha=0.2)
+            if model.age_data is not None:
+                for ax in axs:
+                    ax.axvline(model.age_data[0], color="r", linestyle="--")
+
+        axs[0].set_xlim(time.min(), time.max())
+        plt.tight_layout()
+        if show == True:
+            plt.show()
+
+        return fig
+
+
+class BandAccumulator:
+
+    # Streaming quantiles: every added evolution is interpolated (in log-log) onto the
+    # band times, and its log10 values are counted in a fixed histogram per quantity
+    # and time, so memory does not grow with the number of samples. The histogram range
+    # is set from the first nbuffer evolutions, padded by pad dex on each side; values
+    # outside it fall in the edge bins. Quantiles are read off the cumulative histograms.
+
+    def __init__(self, times, units, time_unit, quantiles=(0.16, 0.5, 0.84), nbins=1000,
+                 nbuffer=50, pad=1.0):
+
+        self.times = np.asarray(times, dtype=float)
+        self.log_times = np.log10(self.times)
+        self.units = units
+        self.time_unit = time_unit
+        self.quantiles = np.asarray(quantiles, dtype=float)
+        self.nbins = nbins
+        self.nbuffer = nbuffer
+        self.pad = pad
+
+        self.names = list(QUANTITIES.values())
+        self.counts = np.zeros(len(self.times), dtype=np.int64)
+        self.hist = None
+        self._buffer = []
+
+    def _log_values(self, evol):
+
+        # (valid time mask, {name: log10 values at valid times}) for one evolution
+        time = np.asarray(getattr(evol["Time"], "value", evol["Time"]), dtype=float)
+        positive = time > 0
+        log_time = np.log10(time[positive])
+        valid = (self.log_times >= log_time[0]) & (self.log_times <= log_time[-1])
+
+        logs = {}
+        for key, name in QUANTITIES.items():
+            val = np.asarray(getattr(evol[key], "value", evol[key]), dtype=float)[positive]
+            logs[name] = np.interp(self.log_times[valid], log_time, np.log10(val))
+
+        return valid, logs
+
+    def _start(self):
+
+        # fix the histogram range from the buffered evolutions
+        lo = {name: np.inf for name in self.names}
+        hi = {name: -np.inf for name in self.names}
+        for _, logs in self._buffer:
+            for name in self.names:
+                if len(logs[name]) > 0:
+                    lo[name] = min(lo[name], logs[name].min())
+                    hi[name] = max(hi[name], logs[name].max())
+
+        self.edges = {name: (lo[name] - self.pad, hi[name] + self.pad) for name in self.names}
+        self.hist = np.zeros((len(self.names), len(self.times), self.nbins), dtype=np.int32)
+
+        buffer, self._buffer = self._buffer, []
+        for valid, logs in buffer:
+            self._count(valid, logs)
+
+    def _count(self, valid, logs):
+
+        tindex = np.flatnonzero(valid)
+        self.counts[tindex] += 1
+        for jj, name in enumerate(self.names):
+            lo, hi = self.edges[name]
+            ibin = np.clip(((logs[name] - lo) / (hi - lo) * self.nbins).astype(int), 0, self.nbins - 1)
+            self.hist[jj, tindex, ibin] += 1
+
+    def add(self, evol):
+
+        # evol: one evolution (plain arrays in model.evol_units, or Quantities)
+        valid, logs = self._log_values(evol)
+        if self.hist is None:
+            self._buffer.append((valid, logs))
+            if len(self._buffer) >= self.nbuffer:
+                self._start()
+        else:
+            self._count(valid, logs)
+
+    def result(self):
+
+        if self.hist is None:
+            self._start()
+
+        values = {}
+        for jj, name in enumerate(self.names):
+            lo, hi = self.edges[name]
+            width = (hi - lo) / self.nbins
+            cdf = np.cumsum(self.hist[jj], axis=1)
+
+            band = np.full((len(self.quantiles), len(self.times)), np.nan)
+            for it in np.flatnonzero(self.counts > 0):
+                for iq, q in enumerate(self.quantiles):
+                    target = q * self.counts[it]
+                    ibin = np.searchsorted(cdf[it], target)
+                    below = cdf[it, ibin-1] if ibin > 0 else 0
+                    frac = (target - below) / max(cdf[it, ibin] - below, 1)
+                    band[iq, it] = 10**(lo + (ibin + frac) * width)
+            values[name] = band
+
+        return PosteriorBands(self.times, self.quantiles, values, self.counts, self.units, self.time_unit)
+
+
+def posterior_bands(model, samples, nsamples=None, times=None, ncores=mp.cpu_count(), chunksize=10,
+                    quantiles=(0.16, 0.5, 0.84), seed=None):
+
+    # Posterior-predictive bands of Lbol, LXRAY, LXUV and Prot from posterior samples
+    # (n, 7). nsamples draws a random subset. Evolutions run on the model's persistent
+    # pool and are folded into the bands as they finish, so tracks come from wherever
+    # the model finds them (cache, track store, library, grid) and never pile up in memory.
+    # times default to 200 log-spaced ages (age_unit) up to the oldest sample.
+
+    samples = np.asarray(samples, dtype=float)
+    if (nsamples is not None) and (nsamples < len(samples)):
+        rng = np.random.default_rng(seed)
+        samples = samples[rng.choice(len(samples), nsamples, replace=False)]
+
+    if times is None:
+        max_age = samples[:, 2].max()
+        times = np.geomspace(max_age * 1e-4, max_age, 200)
+
+    units = {name: model.evol_units[key].to_string() for key, name in QUANTITIES.items()}
+    acc = BandAccumulator(times, units, model.age_unit, quantiles=quantiles)
+
+    for _, evol in model.iter_parameter_sweep(samples, ncores=ncores, chunksize=chunksize,
+                                              ordered=False, units=False):
+        acc.add(evol)
+
+    return acc.result()
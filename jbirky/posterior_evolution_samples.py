@@ -0,0 +1,74 @@
+import numpy as np
+import corner 
+from scipy.stats import norm
+from run_alabi import get_model, bounds, labels, prior_data
+from posterior_bands import posterior_bands
+from chain_reduction import ReducedSamples
+
+
+# ========================================================
+# choose which model run to plot
+
+test = "model1"
+sampler = "emcee"
+ncores = 4
+nsamples = 5000
+model = get_model(test)
+save_dir = f"results/{model.star_name}/{test}/"
+
+# ========================================================
+# Corner plot with priors 
+
+# burned-in, thinned samples written by run_alabi.sample (or python chain_reduction.py <save_dir>)
+emcee_samples = ReducedSamples(f"{save_dir}emcee_samples_reduced").load()
+dynesty_samples = ReducedSamples(f"{save_dir}dynesty_samples_reduced").load()
+
+lw = 1.5
+colors = ["dimgrey", "royalblue", "r"]
+
+fig = corner.corner(emcee_samples,  labels=labels, range=bounds,
+                    show_titles=True, verbose=False, max_n_ticks=4,
+                    plot_contours=True, plot_datapoints=True, plot_density=True,
+                    color=colors[0], no_fill_contours=False, title_kwargs={"fontsize": 16},
+                    label_kwargs={"fontsize": 22}, hist_kwargs={"linewidth":2.0, "density":True})
+
+fig = corner.corner(dynesty_samples, labels=labels, range=bounds, 
+                    show_titles=True, verbose=False, max_n_ticks=4, title_fmt='.3f',
+                    plot_contours=True, plot_datapoints=True, plot_density=True,
+                    color=colors[1], no_fill_contours=False, title_kwargs={"fontsize": 16},
+                    label_kwargs={"fontsize": 22}, hist_kwargs={"linewidth":2.0, "density":True},
+                    fig=fig)
+
+ax_list = fig.axes
+
+xtext = 3.5
+fig.axes[1].text(xtext, 0.725, f"--- Literature Priors", fontsize=26, color=colors[2], ha='left')
+fig.axes[1].text(xtext, 0.55, f"--- emcee Posterior {test}", fontsize=26, color=colors[0], ha='left')
+fig.axes[1].text(xtext, 0.375, f"--- dynesty Posterior {test}", fontsize=26, color=colors[1], ha='left')
+
+panel = 0
+for ii in range(len(bounds)):
+    x = np.linspace(bounds[ii][0], bounds[ii][1], 100)
+    if prior_data[ii][0] is not None:
+        ax_list[panel].plot(x, norm.pdf(x, loc=prior_data[ii][0], scale=prior_data[ii][1]),
+                            lw=lw, color=colors[2], linestyle='--')
+    else:
+        ax_list[panel].axhline(1 / (bounds[ii][1] - bounds[ii][0]), lw=lw, color=colors[2], linestyle='--')
+    panel += len(bounds) + 1
+
+fig.savefig(f"{save_dir}corner_plot_with_priors.png", dpi=300, bbox_inches="tight")
+
+# ========================================================
+# Posterior evolution plot
+
+samples = ReducedSamples(f"{save_dir}{sampler}_samples_reduced").draw(nsamples)
+
+# 16/50/84% posterior-predictive bands of Lbol, LXRAY, LXUV and Prot, folded in as tracks
+# finish on the model's worker pool (tracks come from the cache, store, library or grid)
+bands = posterior_bands(model, samples, nsamples=nsamples, ncores=ncores)
+model.close_pool()
+bands.save(f"{save_dir}posterior_bands_{sampler}.npz")
+
+# replot later without rerunning any track: PosteriorBands.load(file).plot(model)
+fig = bands.plot(model=model, show=True)
+fig.savefig(f"{save_dir}posterior_evolution_bands_{sampler}.png", dpi=300, bbox_inches="tight")
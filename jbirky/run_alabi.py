@@ -1,6 +1,4 @@
-import alabi
-from alabi import utility as ut
-from alabi import SurrogateModel
+import hashlib
 import numpy as np
 from functools import partial
 from astropy import units as u
@@ -8,6 +6,10 @@ from astropy import units as u
 # note: make sure this script is in the same directory as the johnstone_model.py file
 # which should be at /research/yupra/username/
 from johnstone_model import StellarEvolutionModel
+from stage_timer import StageTimer
+from shared_evaluations import SharedEvaluations
+from warm_start import stored_evaluations, library_thetas, rescore, write_initial_samples
+from chain_reduction import reduce_sampler_output
 
 
 # ========================================================
@@ -84,47 +86,184 @@ bounds = [(min_mass, max_mass),         # mass [Msun]
 # Initialize stellar evolution model 
 # We will try multiple configurations using different combinations of data
 # but for now we will use the Lbol and Lxray data ()
+# Each model keeps an LRU cache of up to 200 MB of vplanet tracks per process,
+# backed by an on-disk track store shared across workers, runs and stars.
+# Tracks are run once to the upper age bound and interpolated to each sampled age.
 
+cache_bytes = int(2e8)
+store_dir = "track_store/"
+max_age = bounds[2][1]
 
-model1 = StellarEvolutionModel(star_name=star_name,
-                               Lbol_data=Lbol_data, 
-                               Lxray_data=Lxray_data)
+# Project-wide track library shared by every star: tracks within 1% in mass and
+# 2% in initial Prot of an earlier run (for any star) are reused instead of
+# running vplanet again.
+library_dir = "track_library/"
+library_tolerance = (0.01, 0.02)
 
-model2 = StellarEvolutionModel(star_name=star_name,
-                               Lbol_data=Lbol_data, 
-                               Prot_data=Prot_data)
+# Set profile = True to record per-stage wall times (vplanet, disk, python overhead).
+# Each process writes its aggregates to stage_timing*.json in save_dir, next to
+# alabi's gp_train_time_vs_iteration plot.
+profile = False
 
-model3 = StellarEvolutionModel(star_name=star_name,
-                               Lbol_data=Lbol_data, 
-                               Lxray_data=Lxray_data,
-                               Prot_data=Prot_data)
+# Data used by each model configuration. Models are only built on first use
+# (get_model, or run_alabi.model1 etc.), so importing this script, e.g. from
+# posterior_evolution_samples.py or in spawned alabi workers, stays cheap.
+
+def make_model_data():
+
+    # configurations whose data are all available for this star
+    configs = {"model1": dict(Lbol_data=Lbol_data, Lxray_data=Lxray_data),
+               "model2": dict(Lbol_data=Lbol_data, Prot_data=Prot_data),
+               "model3": dict(Lbol_data=Lbol_data, Lxray_data=Lxray_data, Prot_data=Prot_data)}
+    return {name: data for name, data in configs.items()
+            if all(val is not None for val in data.values())}
+
+model_data = make_model_data()
+
+_models = {}
+
+def get_model(name):
+
+    if name not in _models:
+        _models[name] = StellarEvolutionModel(star_name=star_name,
+                                              cache_bytes=cache_bytes,
+                                              store_dir=store_dir,
+                                              max_age=max_age,
+                                              profile=profile,
+                                              library_dir=library_dir,
+                                              library_tolerance=library_tolerance,
+                                              **model_data[name])
+    return _models[name]
+
+def __getattr__(name):
+
+    # model1 / model2 / model3 as lazy module attributes
+    if name in model_data:
+        return get_model(name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 # ========================================================
 # Configure prior 
 # ========================================================
 
-# Prior sampler - alabi format
-ps = partial(ut.prior_sampler_normal, prior_data=prior_data, bounds=bounds)
+def prior_functions():
+
+    # alabi is only imported when the priors are needed
+    from alabi import utility as ut
+
+    # Prior sampler - alabi format
+    ps = partial(ut.prior_sampler_normal, prior_data=prior_data, bounds=bounds)
 
-# Prior - emcee format
-lnprior = partial(ut.lnprior_normal, bounds=bounds, data=prior_data)
+    # Prior - emcee format
+    lnprior = partial(ut.lnprior_normal, bounds=bounds, data=prior_data)
 
-# Prior - dynesty format
-prior_transform = partial(ut.prior_transform_normal, bounds=bounds, data=prior_data)
+    # Prior - dynesty format
+    prior_transform = partial(ut.prior_transform_normal, bounds=bounds, data=prior_data)
+
+    return ps, lnprior, prior_transform
 
 # ========================================================
 # Configure likelihood
 # ========================================================
 
-def lnlike(theta):
-    _ = model.LXUV_model(theta)
-    chi2_array = model.compute_chi_squared_fit()
-    lnl = -0.5 * np.sum(chi2_array)
+# All configurations are trained in one run from shared evaluations: each theta is
+# evaluated once with shared_model(), which holds every data term, and the stored
+# per-term chi-squared vector gives the log-likelihood of every configuration.
+
+def shared_model():
+
+    if "shared" not in _models:
+        data = {}
+        for config in model_data.values():
+            data.update(config)
+        _models["shared"] = StellarEvolutionModel(star_name=star_name,
+                                                  cache_bytes=cache_bytes,
+                                                  store_dir=store_dir,
+                                                  max_age=max_age,
+                                                  profile=profile,
+                                                  library_dir=library_dir,
+                                                  library_tolerance=library_tolerance,
+                                                  **data)
+    return _models["shared"]
+
+def term_columns(name):
+
+    # columns of the shared chi-squared vector used by configuration name
+    shared = [term for term, _ in shared_model().data_terms()]
+    return [shared.index(term) for term, _ in get_model(name).data_terms()]
+
+_evaluations = {}
+
+def get_evaluations():
+
+    # keyed by the data, so stored chi-squared values are never reused after the data change
+    if "shared" not in _evaluations:
+        terms = shared_model().data_terms()
+        digest = hashlib.sha256(repr(terms).encode()).hexdigest()[:12]
+        _evaluations["shared"] = SharedEvaluations(f"results/{star_name}/shared_evaluations/{digest}/",
+                                                   ndim=len(bounds),
+                                                   nterms=len(terms))
+    return _evaluations["shared"]
+
+def lnlike(theta, name=None):
+    name = name or test
+    evaluations = get_evaluations()
+
+    chi_squared = evaluations.get(theta)
+    if chi_squared is None:
+        chi_squared = shared_model().chi_squared_batch(theta)[0]
+        evaluations.add(theta, chi_squared)
+    lnl = -0.5 * np.sum(chi_squared[term_columns(name)])
+
+    if profile:
+        shared_model().dump_timing(f"results/{star_name}/{name}/")
 
     print("lnlike: ", lnl)
     return lnl
 
+def config_lnlike(name, thetas):
+
+    # log-likelihood of configuration name for thetas already in the shared evaluations
+    evaluations = get_evaluations()
+    chi_squared = np.array([evaluations.get(theta) for theta in thetas]).reshape(len(thetas), -1)
+    return -0.5 * np.sum(chi_squared[:, term_columns(name)], axis=1)
+
+# ========================================================
+# Warm start
+# ========================================================
+
+# Earlier work to seed the training and test sets from (see warm_start.py): sweep
+# directories, other stars' shared_evaluations/<digest>/ directories, alabi savedirs
+# or files of thetas. Their thetas are rescored under this star's data from stored
+# tracks, without running vplanet, and only the remainder of the initial design is
+# evaluated fresh.
+warm_start_sources = []
+
+# number of extra thetas drawn on tracks already in the project track library
+warm_start_library = 0
+
+def seed_evaluations():
+
+    # add every rescorable stored theta to the shared evaluations; returns their thetas
+    model = shared_model()
+    evaluations = get_evaluations()
+
+    thetas, chi_squared = stored_evaluations(model, warm_start_sources, bounds=bounds)
+    if warm_start_library > 0:
+        ps, _, _ = prior_functions()
+        library = library_thetas(model, ps, bounds, warm_start_library)
+        library_chi_squared = rescore(model, library)
+        found = np.all(np.isfinite(library_chi_squared), axis=1)
+        thetas = np.concatenate([thetas, library[found]])
+        chi_squared = np.concatenate([chi_squared, library_chi_squared[found]])
+
+    for theta, row in zip(thetas, chi_squared):
+        if theta not in evaluations:
+            evaluations.add(theta, row)
+
+    return thetas
+
 # def lnpost(theta):
 #     return lnlike(theta) + lnprior(theta)
 
@@ -134,15 +273,28 @@ def lnlike(theta):
 # ========================================================
 
 
-# change these to run different models
+# configurations trained by this run; lnlike defaults to test
+tests = ["model1", "model2", "model3"]
 test = "model1"
-model = eval(test)
 
-save_dir = f"results/{star_name}/{test}/"
+ntrain = 200
+ntest = 100
+ncore = 22
 
+# Each configuration starts from the fixed shared design (shared_design.npz). Setting
+# extra_shared_train > 0 also adds up to that many other stored evaluations (e.g. points
+# other configurations acquired during active learning) to its initial training set;
+# which points are available then depends on what has run before, so the initial set
+# is only reproducible with extra_shared_train = 0.
+extra_shared_train = 0
 
 kernel = "ExpSquaredKernel"
 
+# emcee walkers; chains are reduced (burn-in, thinning) to <savedir>/<sampler>_samples_reduced/
+# keeping at most max_reduced samples
+nwalkers = 50
+max_reduced = 100000
+
 # labels for input parameters
 labels = [r"$m_{\star}$ [M$_{\odot}$]", 
           r"$P_{\rm rot,i}$ [days]", 
@@ -153,32 +305,129 @@ labels = [r"$m_{\star}$ [M$_{\odot}$]",
           r"$R_{X,\rm sat}$"]
 
 
-if __name__ == "__main__":
+def configure_star(name, mass, Lbol, Lxray=None, Prot=None):
+
+    # Switch this script to another star (used by batch_runner.py): replaces the data
+    # block above and rebuilds the mass prior and bounds and the model configurations
+    global star_name, mass_data, Lbol_data, Lxray_data, Prot_data, model_data
+
+    star_name = name
+    mass_data, Lbol_data, Lxray_data, Prot_data = mass, Lbol, Lxray, Prot
+
+    prior_data[0] = (mass_data[0].value, mass_data[1].value)
+    bounds[0] = (max(mass_data[0].value - sigma_factor * mass_data[1].value, grid_min),
+                 min(mass_data[0].value + sigma_factor * mass_data[1].value, grid_max))
+
+    model_data = make_model_data()
+    _models.clear()
+    _evaluations.clear()
+
+def results_dir(name=None):
+    if name is None:
+        return f"results/{star_name}/"
+    return f"results/{star_name}/{name}/"
+
+def run_initial_design(ncore=ncore):
+
+    # One initial design for all configurations, each theta evaluated once. Stored
+    # evaluations (warm start, at most ntrain + ntest of them) fill the design first, split
+    # between the training and test sets in proportion; only the rest is drawn from the
+    # prior and evaluated.
+    ps, _, _ = prior_functions()
+    evaluations = get_evaluations()
+
+    ndim = len(bounds)
+    seeded = np.random.permutation(seed_evaluations()).reshape(-1, ndim)[:ntrain + ntest]
+    nseed_test = min(int(round(len(seeded) * ntest / (ntrain + ntest))), ntest)
+    print("warm start: {} stored evaluations in the design".format(len(seeded)))
+
+    def draw(n):
+        return np.reshape(ps(nsample=n), (-1, ndim)) if n > 0 else np.zeros((0, ndim))
+
+    new_train = draw(ntrain - (len(seeded) - nseed_test))
+    new_test = draw(ntest - nseed_test)
+    if len(new_train) + len(new_test) > 0:
+        evaluations.evaluate(shared_model(), np.vstack([new_train, new_test]), ncores=ncore)
+        shared_model().close_pool()
+
+    train_thetas = np.vstack([seeded[nseed_test:], new_train])
+    test_thetas = np.vstack([seeded[:nseed_test], new_test])
+
+    np.savez(results_dir() + "shared_design.npz", train=train_thetas, test=test_thetas)
+
+def train(test, ncore=ncore):
+
+    from alabi import SurrogateModel
+
+    ps, _, _ = prior_functions()
+    evaluations = get_evaluations()
+    save_dir = results_dir(test)
+
+    # training sample: the shared design, plus at most extra_shared_train other
+    # stored evaluations when enabled
+    design = np.load(results_dir() + "shared_design.npz")
+    train_thetas, test_thetas = design["train"], design["test"]
+    if extra_shared_train > 0:
+        evaluations.refresh()
+        extra, _ = evaluations.arrays(exclude=np.vstack([train_thetas, test_thetas]))
+        extra = np.unique(extra, axis=0)[:extra_shared_train]
+        train_thetas = np.vstack([train_thetas, extra])
+    write_initial_samples(save_dir, train_thetas, config_lnlike(test, train_thetas),
+                          test_thetas, config_lnlike(test, test_thetas))
 
     # Initialize the surrogate model
-    sm = SurrogateModel(fn=lnlike, bounds=bounds, prior_sampler=ps, 
+    sm = SurrogateModel(fn=partial(lnlike, name=test), bounds=bounds, prior_sampler=ps, 
                         savedir=save_dir, cache=True,
-                        labels=labels, scale=None, ncore=22)
+                        labels=labels, scale=None, ncore=ncore)
 
-    # Compute an initial training sample and train the GP
-    sm.init_samples(ntrain=200, ntest=100, reload=False)
+    # Load the initial training sample and train the GP
+    sm.init_samples(ntrain=len(train_thetas), ntest=len(test_thetas), reload=True)
     sm.init_gp(kernel=kernel, fit_amp=False, fit_mean=True, white_noise=-15)
 
     # Train the GP using the active learning algorithm
     sm.active_train(niter=1000, algorithm="bape", gp_opt_freq=10)
     sm.plot(plots=["gp_all"])
 
-    # # Reload the saved model and run MCMC
-    # sm = alabi.cache_utils.load_model_cache(save_dir)
-    # sm.savedir = save_dir
+    if profile:
+        StageTimer.combine(save_dir).report()
+
+    return sm
+
+def sample(test, sampler, ncore=ncore, sm=None):
+
+    # MCMC on the trained surrogate, reloaded from its cache unless given
+    import alabi
+
+    _, lnprior, prior_transform = prior_functions()
+    save_dir = results_dir(test)
+
+    if sm is None:
+        sm = alabi.cache_utils.load_model_cache(save_dir)
+        sm.savedir = save_dir
+    sm.ncore = ncore
 
-    # sm.active_train(niter=500, algorithm="bape", gp_opt_freq=10)
-    # sm.plot(plots=["gp_all"])
+    if sampler == "emcee":
+        # MCMC with emcee
+        sm.run_emcee(lnprior=lnprior, nwalkers=nwalkers, nsteps=int(1e6), opt_init=False)
+        sm.plot(plots=["emcee_corner"])
+
+    elif sampler == "dynesty":
+        # MCMC with dynesty
+        sm.run_dynesty(ptform=prior_transform, mode='dynamic')
+        sm.plot(plots=["dynesty_all"])
+
+    else:
+        raise ValueError("unknown sampler {}; use 'emcee' or 'dynesty'".format(sampler))
+
+    # thinned float32 samples for plots and posterior-predictive bands
+    return reduce_sampler_output(save_dir, sampler, sm=sm, nwalkers=nwalkers, max_samples=max_reduced)
+
+
+if __name__ == "__main__":
 
-    # MCMC with emcee
-    sm.run_emcee(lnprior=lnprior, nwalkers=50, nsteps=int(1e6), opt_init=False)
-    sm.plot(plots=["emcee_corner"])
+    run_initial_design(ncore)
 
-    # MCMC with dynesty
-    sm.run_dynesty(ptform=prior_transform, mode='dynamic')
-    sm.plot(plots=["dynesty_all"])
+    for test in tests:
+        sm = train(test, ncore)
+        for sampler in ["emcee", "dynesty"]:
+            sample(test, sampler, ncore, sm=sm)
@@ -0,0 +1,105 @@
+import os
+import glob
+import json
+import numpy as np
+import multiprocessing as mp
+
+__all__ = ["SharedEvaluations"]
+
+
+class SharedEvaluations:
+
+    # Append-only record of likelihood evaluations shared by several data configurations
+    # of the same star: each row is a theta and the chi-squared of every data term of
+    # one model holding all the data (model.data_terms() order). Any configuration using
+    # a subset of those terms gets its log-likelihood from the stored row, so a theta is
+    # evaluated (and vplanet run) once for all configurations.
+    #
+    # Each process appends raw float64 rows to its own directory/evals_<pid>.bin, so
+    # pool workers never contend for a file; refresh() reads every file back.
+
+    def __init__(self, directory, ndim, nterms):
+
+        self.directory = directory
+        self.ndim = ndim
+        self.nterms = nterms
+        os.makedirs(self.directory, exist_ok=True)
+
+        # row layout, so the evaluations can be read back without the model (warm_start.py)
+        meta = os.path.join(self.directory, "meta.json")
+        if not os.path.exists(meta):
+            with open(meta, "w") as f:
+                json.dump({"ndim": ndim, "nterms": nterms}, f)
+
+        self.refresh()
+
+    @classmethod
+    def open(cls, directory):
+
+        # existing evaluations, with the row layout read from directory/meta.json
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+        return cls(directory, meta["ndim"], meta["nterms"])
+
+    def key(self, theta):
+        return tuple(np.asarray(theta, dtype=float).ravel())
+
+    def refresh(self):
+
+        self.records = {}
+        width = self.ndim + self.nterms
+        for file in sorted(glob.glob(os.path.join(self.directory, "evals_*.bin"))):
+            data = np.fromfile(file, dtype=np.float64)
+            # ignore a partially written last row
+            data = data[:(len(data) // width) * width].reshape(-1, width)
+            for row in data:
+                self.records[self.key(row[:self.ndim])] = row[self.ndim:]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, theta):
+        return self.key(theta) in self.records
+
+    def get(self, theta):
+        return self.records.get(self.key(theta))
+
+    def add(self, theta, chi_squared):
+
+        row = np.concatenate([np.asarray(theta, dtype=np.float64).ravel(),
+                              np.asarray(chi_squared, dtype=np.float64).ravel()])
+        self.records[self.key(theta)] = row[self.ndim:]
+
+        # one write per row on an O_APPEND descriptor
+        file = os.path.join(self.directory, "evals_{}.bin".format(os.getpid()))
+        fd = os.open(file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, row.tobytes())
+        finally:
+            os.close(fd)
+
+    def evaluate(self, model, thetas, ncores=mp.cpu_count(), chunksize=1):
+
+        # chi-squared of every term for each theta, shape (n, nterms), running
+        # model.chi_squared_batch on the model's pool (map_chi_squared) only for thetas not yet stored
+        thetas = np.atleast_2d(np.asarray(thetas, dtype=float))
+        todo = [ii for ii, theta in enumerate(thetas) if theta not in self]
+
+        if len(todo) > 0:
+            chunks = [thetas[todo[start:start+chunksize]] for start in range(0, len(todo), chunksize)]
+            for chunk, chi_squared in zip(chunks, model.map_chi_squared(chunks, ncores)):
+                for theta, row in zip(chunk, chi_squared):
+                    self.add(theta, row)
+
+        return np.array([self.get(theta) for theta in thetas])
+
+    def arrays(self, exclude=None):
+
+        # (thetas, chi_squared) of every stored evaluation, except those in exclude
+        skip = set() if exclude is None else set(self.key(theta) for theta in np.atleast_2d(exclude))
+        keys = [key for key in self.records.keys() if key not in skip]
+
+        thetas = np.array(keys).reshape(-1, self.ndim)
+        chi_squared = np.array([self.records[key] for key in keys]).reshape(-1, self.nterms)
+
+        return thetas, chi_squared
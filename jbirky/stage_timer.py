@@ -0,0 +1,115 @@
+import os
+import glob
+import json
+import time
+import contextlib
+import multiprocessing as mp
+
+__all__ = ["StageTimer", "STAGES"]
+
+
+# stages recorded by StellarEvolutionModel and VplanetRunner; activity_law includes
+# the EUV_relation time spent inside it. units is the conversion of each vplanet run's
+# output to model units; quantities wraps an evolution as Quantities (LXUV_model)
+STAGES = ["infile_write", "vplanet", "parse", "units", "activity_law", "EUV_relation", "chi_squared",
+          "quantities"]
+
+_DISABLED = contextlib.nullcontext()
+
+
+class _Stage:
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimer:
+
+    # Opt-in wall-clock profiler aggregated per stage: number of calls, total, min and
+    # max time [s]. A disabled timer hands out a shared no-op context manager, so the
+    # instrumented code pays only for one attribute check.
+    #
+    #     with timer.stage("vplanet"):
+    #         ...
+
+    def __init__(self, enabled=False):
+
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+
+    def stage(self, name):
+
+        if not self.enabled:
+            return _DISABLED
+        return _Stage(self, name)
+
+    def add(self, name, seconds, count=1, smin=None, smax=None):
+
+        entry = self.timings.setdefault(name, {"count": 0, "total": 0.0, "min": float("inf"), "max": 0.0})
+        entry["count"] += count
+        entry["total"] += seconds
+        entry["min"] = min(entry["min"], seconds if smin is None else smin)
+        entry["max"] = max(entry["max"], seconds if smax is None else smax)
+
+    def merge(self, timings):
+
+        # add aggregates from another timer (e.g. a pool worker's stats())
+        for name, entry in timings.items():
+            self.add(name, entry["total"], count=entry["count"], smin=entry["min"], smax=entry["max"])
+
+    def stats(self):
+
+        # {stage: {count, total, mean, min, max}}, in STAGES order first
+        names = [name for name in STAGES if name in self.timings]
+        names += [name for name in self.timings if name not in STAGES]
+
+        stats = {}
+        for name in names:
+            entry = dict(self.timings[name])
+            entry["mean"] = entry["total"] / entry["count"]
+            stats[name] = entry
+
+        return stats
+
+    def report(self):
+
+        for name, entry in self.stats().items():
+            print("{:<15} n = {:<8d} total = {:10.3f} s   mean = {:.3e} s   max = {:.3e} s".format(
+                  name, entry["count"], entry["total"], entry["mean"], entry["max"]))
+
+    def dump(self, directory):
+
+        # stage_timing.json in directory, or stage_timing_<pid>.json from worker
+        # processes (read all of them back together with StageTimer.combine)
+        os.makedirs(directory, exist_ok=True)
+        if mp.current_process().name == "MainProcess":
+            file = os.path.join(directory, "stage_timing.json")
+        else:
+            file = os.path.join(directory, "stage_timing_{}.json".format(os.getpid()))
+
+        with open(file, "w") as f:
+            json.dump(self.stats(), f, indent=4)
+
+        return file
+
+    @classmethod
+    def combine(cls, directory):
+
+        # one timer aggregating every stage_timing*.json in directory
+        timer = cls(enabled=True)
+        for file in sorted(glob.glob(os.path.join(directory, "stage_timing*.json"))):
+            with open(file, "r") as f:
+                timer.merge(json.load(f))
+
+        return timer
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import math
+import time
+
+# Deterministic stand-in for the vplanet executable, used by benchmark.py.
+#
+#     stub_vplanet.py vpl.in
+#
+# Reads the same vpl.in / body infiles as vplanet (sSystemName, saBodyFiles, dStopTime,
+# dOutputTime, sName, dMass, dRotPeriod, dAge, saOutputOrder), sleeps for
+# VPLANET_STUB_LATENCY seconds (default 0) to mimic the cost of a real run, and
+# writes <system>.<body>.forward with one row per output step in vplanet's output
+# units. The tracks are smooth analytic approximations of pre-main-sequence
+# contraction and magnetic spin-down, not physical models: they only need realistic
+# shapes and sizes, and to be identical for identical inputs.
+
+
+def read_infile(file):
+
+    params = {}
+    with open(file, "r") as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line:
+                key, *values = line.split()
+                params[key] = values
+    return params
+
+
+def turnover_time(teff):
+    return 314.24 * math.exp(-(teff / 1952.5) - (teff / 6250.)**18) + 0.002
+
+
+def star_state(mass, prot0, age0, age):
+
+    # Lbol [Lsun], radius [Rsun], Teff [K], Prot [days] at stellar age [yr]
+    lum_ms = 0.23 * mass**2.3 if mass < 0.43 else mass**4
+    rad_ms = mass**0.8
+    contraction = 1 + (3e7 / age)**0.6
+
+    lum = lum_ms * contraction**1.5
+    rad = rad_ms * contraction
+    teff = 5772. * (lum / rad**2)**0.25
+
+    # spin-up while contracting, Skumanich-like spin-down afterwards
+    rad0 = rad_ms * (1 + (3e7 / age0)**0.6)
+    prot = prot0 * (rad / rad0)**2 * math.sqrt(1 + (age - age0) / (1e8 * mass))
+
+    return lum, rad, teff, prot
+
+
+def columns(mass, prot0, age0, time):
+
+    age = age0 + time
+    lum, rad, teff, prot = star_state(mass, prot0, age0, age)
+    rossby = prot / turnover_time(teff)
+    lxuv = lum * 1e-3 * min(1.0, (rossby / 0.1)**-2)
+
+    return {"Time": time,
+            "Luminosity": lum,
+            "LXUVStellar": lxuv,
+            "Radius": rad,
+            "Temperature": teff,
+            "RotPer": prot,
+            "RossbyNumber": rossby,
+            "RadGyra": 0.3 + 0.15 * math.exp(-age / 1e8)}
+
+
+def main(primary):
+
+    path = os.path.dirname(os.path.abspath(primary))
+    vpl = read_infile(primary)
+
+    system = vpl["sSystemName"][0]
+    stop = float(vpl["dStopTime"][0])
+    step = float(vpl["dOutputTime"][0])
+
+    time.sleep(float(os.environ.get("VPLANET_STUB_LATENCY", 0)))
+
+    # like vplanet, never write past dStopTime; the last row is always at dStopTime
+    nsteps = int(math.floor(stop / step + 1e-9))
+    times = [ii * step for ii in range(nsteps + 1)]
+    if times[-1] < stop:
+        times.append(stop)
+
+    for body_file in vpl["saBodyFiles"]:
+        body = read_infile(os.path.join(path, body_file))
+        name = body["sName"][0]
+        mass = float(body["dMass"][0])
+        prot0 = abs(float(body["dRotPeriod"][0]))
+        age0 = float(body["dAge"][0])
+        order = [re.sub(r"^-", "", col) for col in body["saOutputOrder"]]
+
+        lines = []
+        for t in times:
+            row = columns(mass, prot0, age0, t)
+            lines.append(" ".join("{:.6e}".format(row[col]) for col in order))
+
+        with open(os.path.join(path, "{}.{}.forward".format(system, name)), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 2:
+        sys.exit("usage: stub_vplanet.py vpl.in")
+    main(sys.argv[1])
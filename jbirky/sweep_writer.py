@@ -0,0 +1,113 @@
+import os
+import glob
+import json
+import time
+import tempfile
+import numpy as np
+
+__all__ = ["SweepWriter"]
+
+
+class SweepWriter:
+
+    # Append-only, checkpointed storage for a parameter sweep.
+    #
+    # directory/
+    #     thetas.npy         all thetas of the sweep (checked on resume)
+    #     units.json         unit of each evol key
+    #     shard_000000.npz   index, theta, length and one NaN-padded (n, ntime)
+    #     shard_000001.npz   array per evol key for up to shard_size finished runs
+    #
+    # Finished runs are flushed to a new shard once shard_size of them are buffered or
+    # flush_interval seconds passed since the last shard, so a killed sweep loses at most
+    # the runs of its last few seconds. Shards are written to a temporary file and moved
+    # into place, so an interrupted sweep leaves only complete shards. Re-opening the
+    # directory with the same thetas picks up where it stopped: completed() lists the
+    # indices already done.
+
+    def __init__(self, directory, thetas, units, shard_size=50, flush_interval=10.):
+
+        self.directory = directory
+        self.thetas = np.asarray(thetas, dtype=float)
+        self.units = {name: str(unit) for name, unit in units.items()}
+        self.shard_size = shard_size
+        self.flush_interval = flush_interval
+        os.makedirs(self.directory, exist_ok=True)
+
+        thetas_file = os.path.join(self.directory, "thetas.npy")
+        if os.path.exists(thetas_file):
+            saved = np.load(thetas_file)
+            if (saved.shape != self.thetas.shape) or (not np.allclose(saved, self.thetas)):
+                raise ValueError("{} holds a different sweep; use a new directory".format(self.directory))
+        else:
+            np.save(thetas_file, self.thetas)
+            with open(os.path.join(self.directory, "units.json"), "w") as f:
+                json.dump(self.units, f)
+
+        self._buffer = []
+        self._flushed = time.time()
+        self._nshard = len(self.shard_files())
+
+    def shard_files(self):
+        return sorted(glob.glob(os.path.join(self.directory, "shard_*.npz")))
+
+    def completed(self):
+
+        done = set()
+        for file in self.shard_files():
+            with np.load(file) as data:
+                done.update(int(ii) for ii in data["index"])
+        return done
+
+    def remaining(self):
+
+        done = self.completed()
+        return np.array([ii for ii in range(len(self.thetas)) if ii not in done], dtype=int)
+
+    def append(self, index, evol):
+
+        # evol: dict of plain arrays (as returned by LXUV_model(theta, units=False))
+        self._buffer.append((int(index), evol))
+        if (len(self._buffer) >= self.shard_size) or (time.time() - self._flushed >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+
+        if len(self._buffer) == 0:
+            return
+
+        index = np.array([ii for ii, _ in self._buffer])
+        lengths = np.array([len(evol["Time"]) for _, evol in self._buffer])
+        ntime = lengths.max()
+
+        arrays = {"index": index, "theta": self.thetas[index], "length": lengths}
+        for name in self._buffer[0][1].keys():
+            padded = np.full((len(self._buffer), ntime), np.nan)
+            for jj, (_, evol) in enumerate(self._buffer):
+                padded[jj, :lengths[jj]] = evol[name]
+            arrays["evol." + name] = padded
+
+        file = os.path.join(self.directory, "shard_{:06d}.npz".format(self._nshard))
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, file)
+
+        self._nshard += 1
+        self._buffer = []
+        self._flushed = time.time()
+
+    def close(self):
+        self.flush()
+
+    def __iter__(self):
+
+        # (index, theta, evol) for every stored run, one shard in memory at a time
+        for file in self.shard_files():
+            with np.load(file) as data:
+                names = [key[len("evol."):] for key in data.files if key.startswith("evol.")]
+                evols = {name: data["evol." + name] for name in names}
+                index, thetas, lengths = data["index"], data["theta"], data["length"]
+                for jj, ii in enumerate(index):
+                    evol = {name: evols[name][jj, :lengths[jj]] for name in names}
+                    yield int(ii), thetas[jj], evol
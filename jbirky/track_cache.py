@@ -0,0 +1,95 @@
+from collections import OrderedDict
+import numpy as np
+
+__all__ = ["TrackCache", "track_nbytes"]
+
+
+def track_nbytes(track):
+
+    # total size of the arrays stored in an evolution track dict
+    return int(sum(np.asarray(val).nbytes for val in track.values()))
+
+
+class TrackCache:
+
+    # Bounded in-memory LRU cache of vplanet evolution tracks.
+    # Entries are evicted (least recently used first) once either max_size
+    # entries or max_bytes of array data is exceeded. Either bound may be None.
+
+    def __init__(self, max_size=None, max_bytes=None):
+
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+
+        self._tracks = OrderedDict()
+        self._sizes = {}
+        self.nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def __contains__(self, key):
+        return key in self._tracks
+
+    def get(self, key):
+
+        if key in self._tracks:
+            self._tracks.move_to_end(key)
+            self.hits += 1
+            return self._tracks[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, track):
+
+        if key in self._tracks:
+            self._remove(key)
+
+        size = track_nbytes(track)
+
+        # a single track larger than the byte budget is never cached
+        if (self.max_bytes is not None) and (size > self.max_bytes):
+            return
+
+        self._tracks[key] = track
+        self._sizes[key] = size
+        self.nbytes += size
+
+        while self._over_budget():
+            oldest = next(iter(self._tracks))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def clear(self):
+
+        self._tracks.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+    def stats(self):
+
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._tracks),
+                "nbytes": self.nbytes,
+                "max_size": self.max_size,
+                "max_bytes": self.max_bytes}
+
+    def _over_budget(self):
+
+        if (self.max_size is not None) and (len(self._tracks) > self.max_size):
+            return True
+        if (self.max_bytes is not None) and (self.nbytes > self.max_bytes):
+            return True
+        return False
+
+    def _remove(self, key):
+
+        del self._tracks[key]
+        self.nbytes -= self._sizes.pop(key)
@@ -0,0 +1,149 @@
+import numpy as np
+from astropy import units as u
+import multiprocessing as mp
+
+__all__ = ["TrackGrid"]
+
+
+class TrackGrid:
+
+    # Precomputed grid of vplanet tracks over (mass, initial Prot), each sampled on a
+    # common log-spaced age grid. Queries are answered by multilinear interpolation in
+    # (mass, Prot, log age) of the log10 of each output, so no vplanet run is needed.
+
+    def __init__(self, masses, prots, ages, values, units, age_unit=u.Gyr):
+
+        # values: dict of output name -> array of shape (nmass, nprot, nage)
+        # units: dict of output name -> unit string
+
+        self.masses = np.asarray(masses, dtype=float)
+        self.prots = np.asarray(prots, dtype=float)
+        self.ages = np.asarray(ages, dtype=float)
+        self.values = values
+        self.units = units
+        self.age_unit = u.Unit(age_unit)
+
+        from scipy.interpolate import RegularGridInterpolator
+
+        points = (self.masses, self.prots, np.log10(self.ages))
+        self._interp = {name: RegularGridInterpolator(points, np.log10(val))
+                        for name, val in self.values.items()}
+
+    @classmethod
+    def build(cls, model, masses, prots, ages, ncores=mp.cpu_count()):
+
+        # Run one vplanet track per (mass, Prot) grid point out to max(ages), in parallel
+        # on the model's pool, and resample each onto the age grid (in model.age_unit)
+
+        ages = np.asarray(ages, dtype=float)
+        max_age = ages.max()
+        structural = [(mstar, prot, max_age) for mstar in masses for prot in prots]
+        tracks = model.map_tracks(structural, ncores=ncores)
+
+        # model tracks are plain arrays in model.evol_units
+        names = [name for name in tracks[0].keys() if name != "Time"]
+        units = {name: model.evol_units[name].to_string() for name in names}
+
+        values = {name: np.zeros((len(masses), len(prots), len(ages))) for name in names}
+        for ii, track in enumerate(tracks):
+            im, ip = divmod(ii, len(prots))
+            for name in names:
+                values[name][im, ip] = np.interp(ages, track["Time"], track[name])
+
+        return cls(masses, prots, ages, values, units, age_unit=model.age_unit)
+
+    def save(self, file):
+
+        arrays = {"grid." + name: val for name, val in self.values.items()}
+        np.savez(file, masses=self.masses, prots=self.prots, ages=self.ages,
+                 names=np.array(list(self.values.keys())),
+                 units=np.array([self.units[name] for name in self.values.keys()]),
+                 age_unit=np.array(self.age_unit.to_string()), **arrays)
+
+    @classmethod
+    def load(cls, file):
+
+        with np.load(file) as data:
+            names = [str(name) for name in data["names"]]
+            units = dict(zip(names, [str(unit) for unit in data["units"]]))
+            values = {name: data["grid." + name] for name in names}
+            return cls(data["masses"], data["prots"], data["ages"], values, units,
+                       age_unit=str(data["age_unit"]))
+
+    def to_units(self, age_unit, units):
+
+        # copy of the grid with ages in age_unit and each output in units[name]
+        factors = {name: u.Unit(self.units[name]).to(units[name]) for name in self.values.keys()}
+        values = {name: val * factors[name] for name, val in self.values.items()}
+        new_units = {name: u.Unit(units[name]).to_string() for name in self.values.keys()}
+        ages = self.ages * self.age_unit.to(age_unit)
+
+        return TrackGrid(self.masses, self.prots, ages, values, new_units, age_unit=age_unit)
+
+    def interpolate(self, mstar, prot, ages):
+
+        # outputs at the given ages (in age_unit) for one (mass, Prot), as plain
+        # arrays in the grid units
+        ages = np.atleast_1d(np.asarray(ages, dtype=float))
+        points = np.column_stack([np.full(len(ages), mstar), np.full(len(ages), prot), np.log10(ages)])
+
+        return {name: 10**self._interp[name](points) for name in self.values.keys()}
+
+    def track(self, mstar, prot, age):
+
+        # track on the grid ages up to age, with the final row at exactly age,
+        # in the same format returned by StellarEvolutionModel.run_track
+        ages = np.append(self.ages[self.ages < age], age)
+
+        track = self.interpolate(mstar, prot, ages)
+        track["Time"] = ages
+
+        return track
+
+    def validate(self, model, thetas, ncores=mp.cpu_count()):
+
+        # Compare interpolated final values against real vplanet runs at held-out
+        # (mass, Prot, age) points. Returns the relative error of each output.
+
+        thetas = np.asarray(thetas, dtype=float)
+        tracks = model.map_tracks(thetas[:, :3], ncores=ncores)
+
+        errors = {name: np.zeros(len(thetas)) for name in self.values.keys()}
+        for ii, track in enumerate(tracks):
+            mstar, prot, age = thetas[ii, :3]
+            interp = self.interpolate(mstar, prot, age)
+            for name in errors.keys():
+                true = track[name][-1]
+                errors[name][ii] = (interp[name][0] - true) / true
+
+        return errors
+
+    def report(self, errors):
+
+        for name, err in errors.items():
+            print("{:<35} median |rel err| = {:.2e}   max |rel err| = {:.2e}".format(
+                  name, np.median(np.abs(err)), np.max(np.abs(err))))
+
+
+if __name__ == '__main__':
+
+    from johnstone_model import StellarEvolutionModel
+
+    model = StellarEvolutionModel()
+
+    # Baraffe grid mass range [Msun], initial Prot range [days], ages [Gyr]
+    masses = np.linspace(0.07, 1.4, 134)
+    prots = np.geomspace(0.1, 12.0, 40)
+    ages = np.geomspace(6e-3, 12.0, 300)
+
+    grid = TrackGrid.build(model, masses, prots, ages)
+    grid.save("track_grid.npz")
+
+    # held-out interpolation error against real vplanet runs
+    nval = 50
+    thetas = np.array([np.random.uniform(0.07, 1.4, nval),
+                       np.random.uniform(0.1, 12.0, nval),
+                       np.random.uniform(0.1, 12.0, nval)]).T
+
+    errors = grid.validate(model, thetas)
+    grid.report(errors)
@@ -0,0 +1,133 @@
+import os
+import glob
+import time
+import numpy as np
+
+from track_store import TrackStore
+
+__all__ = ["TrackLibrary"]
+
+
+class TrackLibrary:
+
+    # Project-wide library of evolution tracks for reuse across stars. Tracks depend only
+    # on (mass, initial Prot, age), so a query is answered by an existing track whose
+    # mass and initial Prot lie within tolerance of the request:
+    #
+    #     mode="nearest"      the closest stored track
+    #     mode="interpolate"  inverse-distance weighted mean (in log10) of up to
+    #                         k stored tracks within tolerance, on the closest one's times
+    #
+    # A stored track is only used if it was run at least to the requested age; it is then
+    # cut to end there. Tracks are kept in a TrackStore (same fingerprint rules as the
+    # model's track store), and their inputs in append-only per-process index files
+    # directory/index_<fingerprint>_<pid>.bin, re-read at most every refresh_interval s.
+
+    def __init__(self, directory, fingerprint, tolerance=(0.01, 0.02), mode="nearest", k=4,
+                 refresh_interval=30.):
+
+        # tolerance: (relative mass difference, difference in ln initial Prot)
+        if mode not in ("nearest", "interpolate"):
+            raise ValueError("unknown mode {}; use 'nearest' or 'interpolate'".format(mode))
+
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.tolerance = tolerance
+        self.mode = mode
+        self.k = k
+        self.refresh_interval = refresh_interval
+        self.store = TrackStore(os.path.join(directory, "tracks"), fingerprint)
+
+        self.hits = 0
+        self.misses = 0
+        self.refresh()
+
+    def index_pattern(self):
+        return os.path.join(self.directory, "index_{}_*.bin".format(self.fingerprint[:16]))
+
+    def refresh(self):
+
+        rows = [np.zeros((0, 3))]
+        for file in sorted(glob.glob(self.index_pattern())):
+            data = np.fromfile(file, dtype=np.float64)
+            rows.append(data[:(len(data) // 3) * 3].reshape(-1, 3))
+
+        inputs = np.unique(np.concatenate(rows), axis=0)
+        self.masses, self.prots, self.ages = inputs.T
+        self.log_prots = np.log(self.prots)
+        self._refreshed = time.time()
+
+    def __len__(self):
+        return len(self.masses)
+
+    def stats(self):
+        return {"tracks": len(self), "hits": self.hits, "misses": self.misses}
+
+    def add(self, inputs, track):
+
+        # inputs: (mass, Prot, age) the track was run for, as used by the model's keys
+        inputs = tuple(float(x) for x in inputs)
+        self.store.put(inputs, track)
+
+        file = os.path.join(self.directory, "index_{}_{}.bin".format(self.fingerprint[:16], os.getpid()))
+        fd = os.open(file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, np.asarray(inputs, dtype=np.float64).tobytes())
+        finally:
+            os.close(fd)
+
+        self.masses = np.append(self.masses, inputs[0])
+        self.prots = np.append(self.prots, inputs[1])
+        self.log_prots = np.append(self.log_prots, np.log(inputs[1]))
+        self.ages = np.append(self.ages, inputs[2])
+
+    def neighbours(self, mstar, prot, age):
+
+        # indices and scaled distances (<= 1) of stored tracks within tolerance that
+        # reach age, closest first
+        if time.time() - self._refreshed > self.refresh_interval:
+            self.refresh()
+
+        dist = np.sqrt(((self.masses - mstar) / (mstar * self.tolerance[0]))**2
+                       + ((self.log_prots - np.log(prot)) / self.tolerance[1])**2)
+        dist[self.ages < age] = np.inf
+
+        order = np.argsort(dist)[:self.k if self.mode == "interpolate" else 1]
+        order = order[dist[order] <= 1]
+
+        return order, dist[order]
+
+    def lookup(self, mstar, prot, age, truncate):
+
+        # track for (mstar, prot, age) built from the library, or None. truncate(track, age)
+        # cuts a stored track down to the requested age (the model's truncate_track)
+        order, dist = self.neighbours(mstar, prot, age)
+
+        tracks = []
+        for ii, d in zip(order, dist):
+            inputs = (float(self.masses[ii]), float(self.prots[ii]), float(self.ages[ii]))
+            track = self.store.get(inputs, mmap=False)
+            if track is not None:
+                tracks.append((track, d))
+
+        if len(tracks) == 0:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        if (len(tracks) == 1) or (tracks[0][1] == 0):
+            return truncate(tracks[0][0], age)
+
+        # inverse-distance weights, interpolated in log10 on the closest track's times
+        base = tracks[0][0]
+        weights = np.array([1 / d for _, d in tracks])
+        weights /= weights.sum()
+
+        track = {"Time": base["Time"]}
+        for name in base.keys():
+            if name == "Time":
+                continue
+            logs = [np.log10(np.interp(base["Time"], tr["Time"], tr[name])) for tr, _ in tracks]
+            track[name] = 10**np.sum(weights[:, None] * np.array(logs), axis=0)
+
+        return truncate(track, age)
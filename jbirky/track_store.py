@@ -0,0 +1,105 @@
+import os
+import glob
+import hashlib
+import tempfile
+import subprocess
+import numpy as np
+
+__all__ = ["TrackStore", "vplanet_version", "infile_fingerprint"]
+
+
+def vplanet_version():
+
+    # version of the vplanet python package, falling back on the executable
+    try:
+        import vplanet
+        return str(vplanet.__version__)
+    except (ImportError, AttributeError):
+        pass
+
+    try:
+        out = subprocess.run(["vplanet", "-v"], capture_output=True, text=True, timeout=30)
+        return out.stdout.strip() or out.stderr.strip() or "unknown"
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+
+
+def infile_fingerprint(inpath, version=None, extra=""):
+
+    # sha256 over every infile template in inpath (e.g. star.in, vpl.in),
+    # the vplanet version and any extra model configuration string
+    sha = hashlib.sha256()
+    for file in sorted(glob.glob(os.path.join(inpath, "*.in"))):
+        sha.update(os.path.basename(file).encode())
+        with open(file, "rb") as f:
+            sha.update(f.read())
+    sha.update(str(version).encode())
+    sha.update(str(extra).encode())
+
+    return sha.hexdigest()
+
+
+class TrackStore:
+
+    # Content-addressed on-disk store of vplanet evolution tracks.
+    # Each track is one .npy file named by a hash of the infile fingerprint and the
+    # (rounded) structural inputs, so changing star.in / vpl.in or the vplanet version
+    # never returns stale tracks. Files are written to a temporary name and moved into
+    # place with os.replace, so concurrent pool workers and later sessions only ever
+    # see complete files.
+    #
+    # Tracks (dicts of equal-length plain arrays) are saved as one structured array
+    # with a field per output, so get(..., mmap=True) returns zero-copy read-only
+    # views into a memory-mapped file.
+
+    def __init__(self, directory, fingerprint):
+
+        self.directory = directory
+        self.fingerprint = fingerprint
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, inputs):
+        return hashlib.sha256((self.fingerprint + repr(tuple(inputs))).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".npy")
+
+    def __contains__(self, inputs):
+        return os.path.exists(self.path(self.key(inputs)))
+
+    def get(self, inputs, mmap=True):
+
+        # mmap=False copies the track into memory, e.g. for tracks that will be held
+        # long-term (each live memory map keeps a file descriptor open)
+
+        file = self.path(self.key(inputs))
+        if not os.path.exists(file):
+            return None
+
+        try:
+            data = np.load(file, mmap_mode="r" if mmap else None)
+        except (OSError, ValueError):
+            # unreadable entry: treat as a miss, it will be overwritten
+            return None
+
+        return {name: data[name] for name in data.dtype.names}
+
+    def put(self, inputs, track):
+
+        file = self.path(self.key(inputs))
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+
+        names = list(track.keys())
+        data = np.zeros(len(track[names[0]]), dtype=[(name, float) for name in names])
+        for name in names:
+            data[name] = track[name]
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, data)
+            os.replace(tmp, file)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
@@ -0,0 +1,316 @@
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import numpy as np
+from astropy import units as u
+from multiprocessing import util
+
+from stage_timer import StageTimer
+
+__all__ = ["VplanetRunner", "scratch_root", "read_forward"]
+
+
+# units vplanet reads for infile parameters (given the sUnit* options in vpl.in);
+# a negative template value selects vplanet's custom unit for that parameter
+INFILE_UNITS = {"dMass": u.Msun,
+                "dRotPeriod": u.day,
+                "dAge": u.yr,
+                "dStopTime": u.yr,
+                "dOutputTime": u.yr}
+
+# units vplanet writes for output columns; a "-" prefix selects the custom unit
+OUTPUT_UNITS = {"Time": u.yr,
+                "Luminosity": u.Lsun,
+                "LXUVStellar": u.Lsun,
+                "Radius": u.Rsun,
+                "Temperature": u.K,
+                "RotPer": u.day,
+                "RossbyNumber": u.dimensionless_unscaled,
+                "RadGyra": u.dimensionless_unscaled}
+
+CUSTOM_UNIT_OUTPUTS = ["Luminosity", "LXUVStellar", "Radius", "RotPer"]
+
+# scratch directories of this process, keyed by (parent directory, pid, thread id).
+# They belong to the process and thread rather than to a runner object, so runners
+# unpickled again in a worker (or shared by threads) never create or share extra ones
+_SCRATCH = {}
+
+
+def scratch_root():
+
+    # RAM-backed filesystem when available, otherwise the system temp directory
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def read_forward(file, ncols, sidecar=False):
+
+    # Parse a vplanet .forward file with a known number of columns (from saOutputOrder)
+    # in one bulk read. With sidecar=True the parsed array is also saved next to it as
+    # <file>.npy and later reads memory-map that binary copy instead of re-parsing,
+    # as long as it is at least as new as the text file.
+
+    binary = file + ".npy"
+    if sidecar and os.path.exists(binary) and (os.path.getmtime(binary) >= os.path.getmtime(file)):
+        return np.load(binary, mmap_mode="r")
+
+    with open(file, "r") as f:
+        data = np.fromstring(f.read(), sep=" ")
+    data = data.reshape(-1, ncols)
+
+    if sidecar:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp, binary)
+
+    return data
+
+
+class VplanetRunner:
+
+    # Writes vplanet infiles from the templates in inpath (parsed once, at construction),
+    # runs the vplanet executable and parses the forward file. Output format matches vplanet_inference's
+    # VplanetModel.run_model: {"Time": ..., "final.<body>.<param>": ...} as Quantities.
+    #
+    # Every process (and thread) runs in its own private scratch directory (on /dev/shm when
+    # available) that is reused for all of its runs: infiles and outputs are
+    # overwritten in place rather than created and deleted per evaluation.
+
+    def __init__(self, inparams, outparams, inpath, outpath="output/",
+                       time_init=None, timesteps=None, vplanet_exec="vplanet",
+                       scratch_dir=None, prune_outputs=False, sidecar=False, verbose=False,
+                       timer=None, time_unit=u.yr):
+
+        self.inparams = list(inparams.keys())
+        self.in_units = list(inparams.values())
+        self.outparams = list(outparams.keys())
+        self.out_units = list(outparams.values())
+
+        self.inpath = inpath
+        self.outpath = outpath
+        self.time_init = time_init
+        self.timesteps = timesteps
+        self.vplanet_exec = vplanet_exec
+        self.scratch_parent = scratch_dir if scratch_dir is not None else scratch_root()
+        self.prune_outputs = prune_outputs
+        self.sidecar = sidecar
+        self.verbose = verbose
+        # per-stage wall times (infile_write, vplanet, parse, units) when enabled
+        self.timer = timer if timer is not None else StageTimer()
+
+        self.infile_list = sorted(file for file in os.listdir(self.inpath) if file.endswith(".in"))
+
+        # unit conversion factors, resolved once: model units -> vplanet infile units,
+        # and vplanet output units -> requested output units
+        self.in_factors = [u.Unit(unit).to(INFILE_UNITS[name.split(".")[-1]])
+                           for name, unit in zip(self.inparams, self.in_units)]
+        self.out_factors = [OUTPUT_UNITS[name.split(".")[-1]].to(unit)
+                            for name, unit in zip(self.outparams, self.out_units)]
+        self.time_unit = u.Unit(time_unit)
+        self.time_factor = OUTPUT_UNITS["Time"].to(self.time_unit)
+
+        self.compile_templates()
+
+    def scratch_dir(self):
+
+        key = (self.scratch_parent, os.getpid(), threading.get_ident())
+        path = _SCRATCH.get(key)
+        if path is None:
+            path = tempfile.mkdtemp(prefix="vplanet_{}_{}_".format(*key[1:]), dir=self.scratch_parent)
+            _SCRATCH[key] = path
+            # removed when the process exits, including multiprocessing workers
+            util.Finalize(None, shutil.rmtree, args=(path, True), exitpriority=0)
+
+        return path
+
+    def infile_params(self, theta, final_only=False):
+
+        # {file: {param: value in vplanet infile units}} for the slots that change per run
+        params = {}
+        for name, factor, val in zip(self.inparams, self.in_factors, theta):
+            file, param = name.split(".")
+            params.setdefault(file + ".in", {})[param] = val * factor
+
+        # a single output step spanning the whole run: vplanet writes only the
+        # initial and final rows
+        if final_only and ("dStopTime" in params.get("vpl.in", {})):
+            params["vpl.in"]["dOutputTime"] = params["vpl.in"]["dStopTime"]
+        else:
+            params.setdefault("vpl.in", {})["dOutputTime"] = self.output_time
+
+        return params
+
+    def body_files(self):
+        return [file for file in self.infile_list if file != "vpl.in"]
+
+    def output_order(self, template, prune=False):
+
+        # saOutputOrder from the template, plus any requested outputs it is missing.
+        # prune=True keeps only Time and the requested outputs
+        if prune:
+            order = ["Time"]
+        else:
+            order = re.search(r"saOutputOrder(.*?)(#|$)", template, flags=re.M).group(1).split()
+        names = [col.lstrip("-") for col in order]
+        for name in self.outparams:
+            param = name.split(".")[-1]
+            if param not in names:
+                order.append("-" + param if param in CUSTOM_UNIT_OUTPUTS else param)
+                names.append(param)
+
+        return order
+
+    def compile_templates(self):
+
+        # Read and parse every infile template once. Settings that are the same for every
+        # run (dAge, saOutputOrder) are filled in here; each per-run parameter becomes a
+        # slot. A template is stored as (segments, slots): the literal text pieces, and
+        # the (param, sign) rendered between consecutive pieces.
+
+        slot_params = {"vpl.in": ["dOutputTime"]}
+        for name in self.inparams:
+            file, param = name.split(".")
+            slot_params.setdefault(file + ".in", []).append(param)
+
+        self.templates = {}
+        self.orders = {}
+        self.body_names = {}
+
+        for file in self.infile_list:
+            with open(os.path.join(self.inpath, file), "r") as f:
+                file_in = f.read()
+
+            if file == "vpl.in":
+                self.system_name = re.search(r"^\s*sSystemName\s+(\S+)", file_in, flags=re.M).group(1)
+                if self.timesteps is not None:
+                    self.output_time = self.timesteps.to(u.yr).value
+                else:
+                    self.output_time = float(re.search(r"^\s*dOutputTime\s+(\S+)", file_in, flags=re.M).group(1))
+            else:
+                self.body_names[file] = re.search(r"^\s*sName\s+(\S+)", file_in, flags=re.M).group(1)
+                if self.time_init is not None:
+                    file_in = re.sub(r"^(\s*)dAge\s+\S+",
+                                     lambda m: "{}dAge {:.6e}".format(m.group(1), self.time_init.to(u.yr).value),
+                                     file_in, flags=re.M)
+                order = self.output_order(file_in, prune=self.prune_outputs)
+                self.orders[file] = order
+                file_in = re.sub(r"saOutputOrder.*?(#|$)",
+                                 lambda m: "saOutputOrder " + " ".join(order) + " " + m.group(1),
+                                 file_in, count=1, flags=re.M)
+
+            slots = []
+            for param in slot_params.get(file, []):
+                old = re.search(r"^\s*{}\s+(\S+)".format(param), file_in, flags=re.M)
+                sign = -1 if old.group(1).startswith("-") else 1
+                file_in = re.sub(r"^(\s*){}\s+\S+".format(param),
+                                 lambda m: "{}{} \x00{}\x00".format(m.group(1), param, len(slots)),
+                                 file_in, count=1, flags=re.M)
+                slots.append((param, sign))
+
+            # segments come back in file order, which need not be the order the
+            # slots were created in: reorder the slots by their placeholders
+            pieces = re.split(r"\x00(\d+)\x00", file_in)
+            segments = pieces[0::2]
+            slots = [slots[int(ii)] for ii in pieces[1::2]]
+            self.templates[file] = (segments, slots)
+
+        self.check_templates()
+
+    def check_templates(self):
+
+        # Render every template with a distinct value per slot and read each parameter
+        # back, so a slot written into the wrong parameter fails here rather than silently
+        # running every model with swapped settings (e.g. dStopTime set to dOutputTime)
+        for file, (segments, slots) in self.templates.items():
+            values = {param: float(ii + 1) for ii, (param, _) in enumerate(slots)}
+            rendered = self.render(segments, slots, values)
+            for param, sign in slots:
+                found = re.search(r"^\s*{}\s+(\S+)".format(param), rendered, flags=re.M)
+                if (found is None) or (float(found.group(1)) != sign * values[param]):
+                    raise RuntimeError("template {} renders {} incorrectly".format(file, param))
+
+    def render(self, segments, slots, values):
+
+        parts = [segments[0]]
+        for (param, sign), segment in zip(slots, segments[1:]):
+            parts.append("{:.6e}".format(sign * values[param]))
+            parts.append(segment)
+
+        return "".join(parts)
+
+    def initialize_model(self, theta, path, final_only=False):
+
+        # render each precompiled template and write it with a single buffered write,
+        # overwriting in place: the same file is reused by every run in this directory
+        params = self.infile_params(theta, final_only=final_only)
+
+        for file, (segments, slots) in self.templates.items():
+            rendered = self.render(segments, slots, params.get(file, {}))
+            with open(os.path.join(path, file), "w") as f:
+                f.write(rendered)
+
+    def read_output(self, path, sidecar=False):
+
+        # plain arrays in the OUTPUT_UNITS of each column
+        output = {}
+        for file in self.body_files():
+            body = self.body_names[file]
+            order = self.orders[file]
+
+            forward = os.path.join(path, "{}.{}.forward".format(self.system_name, body))
+            data = read_forward(forward, len(order), sidecar=sidecar)
+
+            for ii, col in enumerate(order):
+                name = col.lstrip("-")
+                if name == "Time":
+                    output["Time"] = data[:, ii]
+                else:
+                    output["final.{}.{}".format(body, name)] = data[:, ii]
+
+        return output
+
+    def run_model(self, theta, remove=True, units=True, final_only=False):
+
+        # remove=True runs in this process's reusable scratch directory;
+        # remove=False keeps the run in its own subdirectory of outpath for inspection.
+        # units=False returns plain arrays (Time in time_unit, outputs in the requested units).
+        # final_only=True writes only the initial and final output rows
+        if remove:
+            path = self.scratch_dir()
+        else:
+            path = os.path.join(self.outpath, hashlib.md5(str(theta).encode("utf-8")).hexdigest())
+            os.makedirs(path, exist_ok=True)
+
+        with self.timer.stage("infile_write"):
+            self.initialize_model(theta, path, final_only=final_only)
+
+        with self.timer.stage("vplanet"):
+            proc = subprocess.run([self.vplanet_exec, "vpl.in"], cwd=path,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise RuntimeError("vplanet failed in {} for theta={}:\n{}".format(
+                               path, theta, proc.stderr.decode(errors="replace")))
+        if self.verbose:
+            print("vplanet run complete:", theta)
+
+        # binary sidecars only pay off for kept runs; scratch output is rewritten every run
+        with self.timer.stage("parse"):
+            output = self.read_output(path, sidecar=(self.sidecar and not remove))
+
+        with self.timer.stage("units"):
+            model_out = {"Time": output["Time"] * self.time_factor}
+            for name, factor in zip(self.outparams, self.out_factors):
+                model_out[name] = output[name] * factor
+
+            if units:
+                model_out["Time"] = model_out["Time"] * self.time_unit
+                for name, unit in zip(self.outparams, self.out_units):
+                    model_out[name] = model_out[name] * unit
+
+        return model_out
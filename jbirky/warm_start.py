@@ -0,0 +1,155 @@
+import os
+import glob
+import json
+import numpy as np
+from astropy import units as u
+
+from johnstone_model import TrackNotAvailable
+from shared_evaluations import SharedEvaluations
+from sweep_writer import SweepWriter
+
+__all__ = ["stored_evaluations", "library_thetas", "rescore", "write_initial_samples"]
+
+# theta = (mass, Prot, age, beta1, beta2, Rosat, RXsat)
+NDIM = 7
+
+
+# Seed alabi's training and test sets from earlier work instead of fresh vplanet runs.
+# A source is any of:
+#
+#     a checkpointed sweep directory (SweepWriter: thetas.npy + shard_*.npz)
+#     a SharedEvaluations directory (meta.json + evals_*.bin), e.g. of another star
+#     an alabi savedir holding initial_training_sample.npz / initial_test_sample.npz
+#     an .npz file with a "theta" (or "samples") array, or an .npy array of thetas
+#
+# library_thetas also draws new thetas on tracks already in the project track library.
+#
+# Every stored theta is rescored under the current model's data. Sweeps store the whole
+# evolution, so they are rescored directly; other sources only store thetas, which are
+# rescored from tracks in the model's cache, track store or track library (model.offline),
+# skipping any theta whose track would need a vplanet run.
+
+
+def sweep_evaluations(model, directory):
+
+    # (thetas, chi-squared of each data term) of a checkpointed sweep, from its stored evolutions
+    with open(os.path.join(directory, "units.json"), "r") as f:
+        units = json.load(f)
+    factors = {name: u.Unit(unit).to(model.evol_units[name]) for name, unit in units.items()
+               if name in model.evol_units}
+
+    writer = SweepWriter(directory, np.load(os.path.join(directory, "thetas.npy")), units)
+    thetas, chi_squared = [], []
+    for _, theta, evol in writer:
+        evol = {name: val * factors[name] for name, val in evol.items() if name in factors}
+        thetas.append(theta)
+        chi_squared.append(model.compute_chi_squared_fit(evol))
+
+    nterms = len(model.data_terms())
+    return np.array(thetas).reshape(-1, NDIM), np.array(chi_squared).reshape(-1, nterms)
+
+
+def source_thetas(source):
+
+    # thetas stored by a source that does not keep evolutions
+    if os.path.isdir(source):
+        if os.path.exists(os.path.join(source, "meta.json")):
+            thetas, _ = SharedEvaluations.open(source).arrays()
+            return thetas
+        files = sorted(glob.glob(os.path.join(source, "initial_*_sample.npz")))
+        if len(files) == 0:
+            raise ValueError("{} holds no sweep, evaluations or alabi samples".format(source))
+        return np.concatenate([np.load(file)["theta"] for file in files])
+
+    if source.endswith(".npy"):
+        return np.load(source)
+
+    with np.load(source) as data:
+        key = "theta" if "theta" in data.files else "samples"
+        return data[key]
+
+
+def library_thetas(model, prior_sampler, bounds, nsample, seed=0):
+
+    # New thetas on tracks already in the model's track library: prior draws whose
+    # (mass, Prot) are replaced by those of random library tracks inside bounds, so
+    # rescore() finds every one of their tracks. With max_age set, any age up to
+    # max_age is served by the same track.
+    library = model.track_library
+    if (library is None) or (len(library) == 0):
+        return np.zeros((0, NDIM))
+
+    inside = ((library.masses >= bounds[0][0]) & (library.masses <= bounds[0][1])
+              & (library.prots >= bounds[1][0]) & (library.prots <= bounds[1][1]))
+    if model.max_age is not None:
+        inside &= library.ages >= model.max_age
+    if not np.any(inside):
+        return np.zeros((0, NDIM))
+
+    rng = np.random.default_rng(seed)
+    pick = rng.choice(np.flatnonzero(inside), nsample)
+
+    thetas = np.array(prior_sampler(nsample=nsample), dtype=float)
+    thetas[:, 0] = library.masses[pick]
+    thetas[:, 1] = library.prots[pick]
+    if model.max_age is None:
+        thetas[:, 2] = library.ages[pick]
+
+    return thetas
+
+
+def rescore(model, thetas):
+
+    # chi-squared of each data term of model for each theta, shape (n, nterms), from
+    # stored tracks only (NaN rows where a track would need a vplanet run)
+    thetas = np.atleast_2d(np.asarray(thetas, dtype=float))
+    chi_squared = np.full((len(thetas), len(model.data_terms())), np.nan)
+
+    offline = model.offline
+    model.offline = True
+    try:
+        for ii, theta in enumerate(thetas):
+            try:
+                chi_squared[ii] = model.chi_squared_batch(theta)[0]
+            except TrackNotAvailable:
+                pass
+    finally:
+        model.offline = offline
+
+    return chi_squared
+
+
+def stored_evaluations(model, sources, bounds=None):
+
+    # (thetas, chi-squared of each data term) from every source, rescored under model,
+    # keeping only unique thetas inside bounds that could be rescored.
+    # The log-likelihood is -0.5 * chi_squared.sum(axis=1).
+    nterms = len(model.data_terms())
+    all_thetas, all_chi_squared = [np.zeros((0, NDIM))], [np.zeros((0, nterms))]
+    for source in sources:
+        if os.path.exists(os.path.join(source, "thetas.npy")):
+            thetas, chi_squared = sweep_evaluations(model, source)
+        else:
+            thetas = np.atleast_2d(source_thetas(source))
+            chi_squared = rescore(model, thetas)
+        all_thetas.append(thetas)
+        all_chi_squared.append(chi_squared)
+
+    thetas = np.concatenate(all_thetas)
+    chi_squared = np.concatenate(all_chi_squared)
+
+    keep = np.all(np.isfinite(chi_squared), axis=1)
+    if bounds is not None:
+        bounds = np.asarray(bounds, dtype=float)
+        keep &= np.all((thetas >= bounds[:, 0]) & (thetas <= bounds[:, 1]), axis=1)
+
+    thetas, index = np.unique(thetas[keep], axis=0, return_index=True)
+    return thetas, chi_squared[keep][index]
+
+
+def write_initial_samples(savedir, train_thetas, train_y, test_thetas, test_y):
+
+    # alabi's reload files: sm.init_samples(..., reload=True) then starts from these
+    os.makedirs(savedir, exist_ok=True)
+    np.savez(os.path.join(savedir, "initial_training_sample.npz"), theta=train_thetas, y=train_y)
+    np.savez(os.path.join(savedir, "initial_test_sample.npz"), theta=test_thetas, y=test_y)